@@ -1,47 +1,57 @@
-import io
 import os
 import re
 import logging
 import tempfile
+import time
+import uuid
+import json
 import configparser
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file
 
 # Import the sheet_handler from the generate_sheets module
 from generate_sheets import sheet_handler, test_config
+from jobs import JobQueue
+from colors import color_registry, COLORS_FILE
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB max upload
 app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))  # generations run at the same time
+app.config['OUTPUT_MAX_AGE'] = int(os.environ.get('OUTPUT_MAX_AGE', 24 * 60 * 60))  # seconds outputs are kept
+app.config['ASYNC_FETCH'] = os.environ.get('ASYNC_FETCH', '') == '1'  # fetch set lists with the asyncio client
 
+# Each job writes its workbook here, named after the job
+OUTPUT_DIR = os.path.join(os.path.dirname(__file__), 'outputs')
 
-def capture_output(fn, *args, **kwargs):
-    """
-    Call fn(*args, **kwargs) and capture all logging output.
-    Attaches a temporary StreamHandler to the root logger so that
-    any logger.info/warning/error calls inside sheet_handler (or
-    any module it imports) are written into a StringIO buffer.
-    """
-    buf = io.StringIO()
-
-    # Clean format - just the message text, no timestamps or level prefix
-    handler = logging.StreamHandler(buf)
-    handler.setLevel(logging.INFO)
-    handler.setFormatter(logging.Formatter('%(message)s'))
+# Job output only needs INFO; keep the per-set debug dumps out of the web app
+logging.getLogger().setLevel(logging.INFO)
 
-    root_logger = logging.getLogger()
-    original_level = root_logger.level
-    root_logger.addHandler(handler)
-    root_logger.setLevel(logging.INFO)
+job_queue = JobQueue(max_workers=app.config['JOB_WORKERS'])
 
-    try:
-        fn(*args, **kwargs)
-    finally:
-        root_logger.removeHandler(handler)
-        root_logger.setLevel(original_level)
-        handler.close()
 
-    return buf.getvalue()
+def cleanup_outputs():
+    """
+    Forget jobs that finished more than OUTPUT_MAX_AGE seconds ago and
+    delete their files, along with any other old files in OUTPUT_DIR
+    (for example from before a restart).
+    """
+    max_age = app.config['OUTPUT_MAX_AGE']
+    for job in job_queue.expire(max_age):
+        if job.result_file and os.path.exists(job.result_file):
+            os.remove(job.result_file)
+
+    if not os.path.isdir(OUTPUT_DIR):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(OUTPUT_DIR):
+        path = os.path.join(OUTPUT_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # Another worker got there first
+            pass
 
 
 @app.route('/')
@@ -51,51 +61,103 @@ def index():
 
 @app.route('/generate', methods=['POST'])
 def generate():
+    """Queue a generation job and return its id straight away."""
     mode = request.form.get('mode')  # 'set' or 'file'
-    error = None
-    output = ''
 
-    try:
-        if mode == 'set':
-            set_number = request.form.get('set_number', '').strip()
+    cleanup_outputs()
 
-            if not set_number:
-                return jsonify({'error': 'Please enter a set number.'}), 400
+    if mode == 'set':
+        set_number = request.form.get('set_number', '').strip()
 
-            if not re.match(r'^\d+-\d+$', set_number):
-                return jsonify({'error': 'Invalid set number format. Use XXXXX-1 (e.g. 75192-1)'}), 400
+        if not set_number:
+            return jsonify({'error': 'Please enter a set number.'}), 400
 
-            output = capture_output(sheet_handler, set_num=set_number, set_list=None, multi_sheet=False)
+        if not re.match(r'^\d+-\d+$', set_number):
+            return jsonify({'error': 'Invalid set number format. Use XXXXX-1 (e.g. 75192-1)'}), 400
 
-        elif mode == 'file':
-            uploaded_file = request.files.get('set_file')
-            multi_sheet = request.form.get('multi_sheet') == 'true'
+        job = job_queue.submit(sheet_handler, set_num=set_number, set_list=None, multi_sheet=False,
+                               description=set_number)
 
-            if not uploaded_file or uploaded_file.filename == '':
-                return jsonify({'error': 'Please upload a set list file.'}), 400
+    elif mode == 'file':
+        uploaded_file = request.files.get('set_file')
+        multi_sheet = request.form.get('multi_sheet') == 'true'
 
-            # Save uploaded file to a temp location
-            with tempfile.NamedTemporaryFile(mode='wb', suffix='.txt', delete=False) as tmp:
-                tmp_path = tmp.name
-                uploaded_file.save(tmp)
+        if not uploaded_file or uploaded_file.filename == '':
+            return jsonify({'error': 'Please upload a set list file.'}), 400
 
-            try:
-                output = capture_output(sheet_handler, set_num=None, set_list=tmp_path, multi_sheet=multi_sheet)
-            finally:
-                os.unlink(tmp_path)
+        # Save uploaded file to a temp location, removed once the job is done
+        with tempfile.NamedTemporaryFile(mode='wb', suffix='.txt', delete=False) as tmp:
+            tmp_path = tmp.name
+            uploaded_file.save(tmp)
 
-        else:
-            return jsonify({'error': 'Invalid mode selected.'}), 400
+        # Every job gets its own workbook so concurrent jobs can't overwrite each other
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        output_file = os.path.join(OUTPUT_DIR, uuid.uuid4().hex + '.xlsx')
 
-    except Exception as e:
-        error = str(e)
+        job = job_queue.submit(sheet_handler, set_num=None, set_list=tmp_path, multi_sheet=multi_sheet,
+                               output_file=output_file, result_file=output_file,
+                               use_async=app.config['ASYNC_FETCH'],
+                               description=uploaded_file.filename,
+                               cleanup=lambda: os.unlink(tmp_path))
 
-    if error:
-        return jsonify({'error': error, 'output': output})
+    else:
+        return jsonify({'error': 'Invalid mode selected.'}), 400
 
+    return jsonify({'job_id': job.id, 'status': job.status}), 202
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    Return a job's status and the output lines logged after ?since=N.
+    Poll again with since set to the returned 'next' to get new lines.
+    """
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job.'}), 404
+    since = request.args.get('since', 0, type=int)
+    return jsonify(job.to_dict(since))
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Return the full output of a finished job, in the same shape /generate used to."""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job.'}), 404
+    if not job.finished_running:
+        return jsonify({'error': 'Job has not finished yet.', 'status': job.status}), 409
+
+    output = '\n'.join(job.lines())
+    if job.error:
+        return jsonify({'error': job.error, 'output': output})
     return jsonify({'output': output or '(No output returned)'})
 
 
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    """Stream a job's output as server-sent events until it finishes."""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job.'}), 404
+
+    def events():
+        since = 0
+        while True:
+            lines = job.wait(since, timeout=15)
+            for line in lines:
+                yield 'data: ' + json.dumps(line) + '\n\n'
+            since += len(lines)
+            if job.finished_running and since == len(job.lines()):
+                yield 'event: end\ndata: ' + json.dumps({'status': job.status, 'error': job.error}) + '\n\n'
+                return
+            if not lines:
+                # Keep idle connections open through proxies
+                yield ': keep-alive\n\n'
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
 
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.ini')
 
@@ -189,20 +251,45 @@ def save_settings():
 
     return jsonify({'ok': True})
 
-@app.route('/download')
-def download():
-    """Serve the generated output file for download.
-    sheet_handler writes to Sets.xlsx in the working directory by default."""
-    output_path = os.path.join(os.path.dirname(__file__), 'Sets.xlsx')
-    if not os.path.exists(output_path):
+@app.route('/jobs/<job_id>/download')
+def download(job_id):
+    """Serve the workbook generated by a job for download."""
+    job = job_queue.get(job_id)
+    if not job or not job.result_file:
+        return jsonify({'error': 'Unknown job.'}), 404
+    if not job.finished_running:
+        return jsonify({'error': 'Job has not finished yet.', 'status': job.status}), 409
+    if not os.path.exists(job.result_file):
         return jsonify({'error': 'Output file not found. Generate a sheet first.'}), 404
     return send_file(
-        output_path,
+        job.result_file,
         as_attachment=True,
         download_name='Sets.xlsx',
         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     )
 
 
+COLORS_PATH = os.path.join(os.path.dirname(__file__), COLORS_FILE)
+
+
+@app.route('/colors')
+def get_colors():
+    """
+    Bricklink color names by id, or with ?name= the id of one color. The
+    colors are read from colors.json once per process.
+    """
+    try:
+        color_registry.ensure_loaded(COLORS_PATH)
+    except (IOError, ValueError):
+        return jsonify({'error': 'Color table not available.'}), 500
+    name = request.args.get('name')
+    if name is None:
+        return jsonify({str(color_id): name for color_id, name in color_registry.as_dict().items()})
+    color_id = color_registry.id(name)
+    if color_id is None:
+        return jsonify({'error': 'Unknown color.'}), 404
+    return jsonify({'color_id': color_id, 'name': color_registry.name(color_id)})
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
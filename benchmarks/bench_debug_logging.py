@@ -0,0 +1,98 @@
+"""
+Measure the CPU the debug dumps cost per item at INFO level.
+
+Logs the same payloads getDetails and getPartDetails dump for every item,
+once with json.dumps evaluated up front as the scripts used to do and once
+through LazyJSON, with the root logger at INFO. Reports CPU time per item
+and the functions that use most of it for the eager version.
+
+Usage: python benchmarks/bench_debug_logging.py [items] [sales per price guide]
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from log_utils import LazyJSON
+
+
+def price_guide(sales, sold):
+    detail = []
+    for _ in range(sales):
+        entry = {'quantity': random.randint(1, 5), 'unit_price': str(round(random.uniform(10, 300), 4)),
+                 'seller_country_code': 'US', 'buyer_country_code': 'US'}
+        if sold:
+            entry['date_ordered'] = '2023-05-27T01:09:39.493Z'
+        else:
+            entry['shipping_available'] = True
+        detail.append(entry)
+    return {'item': {'no': '75192-1', 'type': 'SET'}, 'new_or_used': 'N', 'currency_code': 'USD',
+            'min_price': '10.0000', 'max_price': '300.0000', 'avg_price': '155.0000', 'qty_avg_price': '150.0000',
+            'unit_quantity': sales, 'total_quantity': sales * 3, 'price_detail': detail}
+
+
+def make_payloads(sales):
+    item = {'no': '75192-1', 'name': 'Millennium Falcon', 'type': 'SET', 'category_id': 65,
+            'year_released': 2017, 'image_url': '//img', 'thumbnail_url': '//thumb', 'weight': '13000.00'}
+    category = {'category_id': 65, 'category_name': 'Star Wars', 'parent_id': 0}
+    details = {'75192-1': {'name': item['name'], 'category': 'Star Wars', 'year': 2017,
+                           'current': {'avg': 155, 'min': 10, 'max': 300, 'quantity': sales, 'currency': 'USD'},
+                           'past': {'avg': 155, 'min': 10, 'max': 300, 'quantity': sales, 'currency': 'USD',
+                                    'last_sale_date': '2023-05-27T01:09:39.493Z'}}}
+    return {
+        # getDetails dumps both price guides, the item and the category, and
+        # the writers dump the details again
+        'generate_sheets': [price_guide(sales, False), price_guide(sales, True), item, category, details],
+        # getPartDetails dumps the price guide, item and category, and the
+        # inventory loop the item it sends
+        'inventory_update': [price_guide(sales, False), item, category,
+                             {'item': {'no': '3001', 'type': 'PART'}, 'color_id': 5, 'quantity': 10}],
+    }
+
+
+def eager(payloads):
+    for payload in payloads:
+        logging.debug(json.dumps(payload, indent=4, sort_keys=True))
+
+
+def lazy(payloads):
+    for payload in payloads:
+        logging.debug(LazyJSON(payload))
+
+
+def cpu_per_item(log, payloads, items):
+    start = time.process_time()
+    for _ in range(items):
+        log(payloads)
+    return (time.process_time() - start) / items
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    sales = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    logging.basicConfig(level=logging.INFO)
+
+    print(str(items) + ' items, ' + str(sales) + ' sales per price guide, logging at INFO')
+    for script, payloads in make_payloads(sales).items():
+        before = cpu_per_item(eager, payloads, items)
+        after = cpu_per_item(lazy, payloads, items)
+        print('%-17s eager %8.3f ms/item  lazy %8.4f ms/item  saved %8.3f ms/item' %
+              (script, before * 1000, after * 1000, (before - after) * 1000))
+
+    profile = cProfile.Profile()
+    profile.runcall(cpu_per_item, eager, make_payloads(sales)['generate_sheets'], items)
+    output = io.StringIO()
+    pstats.Stats(profile, stream=output).sort_stats('tottime').print_stats(5)
+    print('\nEager dumps in generate_sheets, by CPU time:')
+    print(output.getvalue())
+
+
+if __name__ == '__main__':
+    main()
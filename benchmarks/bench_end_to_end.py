@@ -0,0 +1,269 @@
+"""
+End-to-end throughput of the scripts against a local Bricklink stand-in.
+
+Starts the stand-in from fake_bricklink.py in this process and runs each
+scenario in a child process of its own, in a fresh working directory with
+a config.ini whose base_url points at the stand-in. Caches, the price
+history and the peak memory of every scenario start from scratch:
+  sheets     - sheet_handler on a set list, fetching on a pool of threads
+  async      - sheet_handler on the same list with the asyncio client
+  inventory  - inventory_update's sync of an Inventory sheet, half new rows
+               and half rows already listed in the store
+  bulk       - the same sync reading the store from one snapshot (-b)
+  web        - POST /generate with the set list, polled until the job is done
+
+For each scenario it reports items (sets or rows) per second, Bricklink
+calls per item, the errors the stand-in injected, the child's peak RSS and
+the time spent saving workbooks. With --output the results are appended as
+one JSON line per scenario, tagged with --label, to compare releases.
+
+Usage: python benchmarks/bench_end_to_end.py [--sets 200] [--rows 200] [--latency 0.05] [--detail-size 500] ...
+"""
+import argparse
+import configparser
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ['sheets', 'async', 'inventory', 'bulk', 'web']
+SET_LIST = 'sets.txt'
+ROWS_FILE = 'rows.json'
+COLOR_IDS = range(1, 12)
+
+
+def set_numbers(count):
+    return [str(10000 + index) + '-1' for index in range(count)]
+
+
+def inventory_rows(count, parts):
+    """Rows for the Inventory sheet, cycling through parts and colors."""
+    return [{'no': str(3000 + index % parts), 'color': COLOR_IDS[index % len(COLOR_IDS)], 'condition': 'U',
+             'quantity': 1 + index % 5} for index in range(count)]
+
+
+def write_config(directory, base_url, pool_size):
+    config = configparser.ConfigParser()
+    config['secrets'] = {key: 'benchmark' for key in ('consumer_key', 'consumer_secret', 'token_value',
+                                                     'token_secret')}
+    config['api'] = {'base_url': base_url, 'pool_size': str(pool_size)}
+    # Only the stand-in's latency should limit the run; retries stay short
+    config['limits'] = {'calls_per_second': '100000', 'burst': '100000', 'daily_budget': '0',
+                        'backoff_base': '0.05', 'backoff_max': '0.5'}
+    with open(os.path.join(directory, 'config.ini'), 'w') as config_file:
+        config.write(config_file)
+
+
+def prepare(fake, scenario, directory, options):
+    """Write a scenario's inputs, and put its listings in the store. Returns the item count."""
+    write_config(directory, fake.base_url, max(32, options.workers))
+    with open(os.path.join(directory, SET_LIST), 'w') as set_list:
+        set_list.write('\n'.join(set_numbers(options.sets)) + '\n')
+
+    if scenario not in ('inventory', 'bulk'):
+        return options.sets
+    fake.inventories.clear()
+    rows = inventory_rows(options.rows, options.parts)
+    for row in rows[::2]:
+        row['inventory_id'] = fake.add_listing(row['no'], row['color'], row['condition'], row['quantity'] + 1)
+    with open(os.path.join(directory, ROWS_FILE), 'w') as rows_file:
+        json.dump(rows, rows_file)
+    return options.rows
+
+
+def run_scenario(fake, scenario, options):
+    directory = tempfile.mkdtemp(prefix='bench-' + scenario + '-')
+    try:
+        items = prepare(fake, scenario, directory, options)
+        fake.reset_stats()
+        with open(os.path.join(directory, 'child.log'), 'w') as log:
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', scenario,
+                                    '--workers', str(options.workers)],
+                                   cwd=directory, stdout=subprocess.PIPE, stderr=log, text=True)
+        if child.returncode != 0:
+            with open(os.path.join(directory, 'child.log')) as log:
+                print(scenario + ' failed:\n' + ''.join(log.readlines()[-20:]))
+            return None
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        result.update(scenario=scenario, items=items, calls=dict(fake.calls), errors=dict(fake.errors))
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def report(results):
+    print('%-10s %6s %8s %9s %10s %7s %12s %7s' % ('scenario', 'items', 'seconds', 'items/s', 'calls/item', 'errors',
+                                                 'peak RSS MB', 'save s'))
+    for result in results:
+        calls = sum(result['calls'].values())
+        print('%-10s %6d %8.2f %9.1f %10.2f %7d %12.1f %7.2f' % (
+            result['scenario'], result['items'], result['seconds'], result['items'] / result['seconds'],
+            calls / result['items'], sum(result['errors'].values()), result['peak_rss_mb'], result['save_seconds']))
+
+
+# Child side: runs one scenario in the current directory and prints its
+# timings as a JSON line
+
+def time_saves():
+    """Wrap Workbook.save to add up the time spent in it."""
+    from openpyxl import Workbook
+
+    saves = []
+    save = Workbook.save
+
+    def timed_save(workbook, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return save(workbook, *args, **kwargs)
+        finally:
+            saves.append(time.perf_counter() - start)
+
+    Workbook.save = timed_save
+    return saves
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def sheets_job(workers, use_async=False):
+    from generate_sheets import sheet_handler
+
+    return lambda: sheet_handler(None, SET_LIST, False, output_file='Sets.xlsx', max_workers=workers,
+                                 use_async=use_async)
+
+
+def inventory_job(workers, bulk_snapshot=False):
+    from openpyxl import Workbook
+    import inventory_sync
+    import inventory_update
+    import session_provider
+    from colors import color_registry
+
+    color_registry.load_file(os.path.join(REPO, 'colors.json'))
+    with open(ROWS_FILE) as rows_file:
+        rows = json.load(rows_file)
+    workbook = Workbook()
+    worksheet = workbook.active
+    worksheet.title = 'Inventory'
+    for row, values in enumerate(rows, inventory_sync.FIRST_ROW):
+        worksheet.cell(row=row, column=inventory_sync.INVENTORY_ID_COLUMN, value=values.get('inventory_id'))
+        worksheet.cell(row=row, column=inventory_sync.TYPE_COLUMN, value='PART')
+        worksheet.cell(row=row, column=inventory_sync.ITEM_COLUMN, value=values['no'])
+        worksheet.cell(row=row, column=inventory_sync.COLOR_COLUMN, value=values['color'])
+        worksheet.cell(row=row, column=inventory_sync.QUANTITY_COLUMN, value=values['quantity'])
+        worksheet.cell(row=row, column=inventory_sync.CONDITION_COLUMN, value=values['condition'])
+        worksheet.cell(row=row, column=inventory_sync.STOCKROOM_COLUMN, value='N')
+        worksheet.cell(row=row, column=inventory_sync.RETAIN_COLUMN, value='N')
+    args = SimpleNamespace(dryrun=False, skip=False, workers=workers, writers=inventory_sync.DEFAULT_WRITERS,
+                           bulk_snapshot=bulk_snapshot)
+
+    def run():
+        session = session_provider.get_session('config.ini')
+        inventory_update.process_inventory(worksheet, session, args)
+        workbook.save(filename='LegoParts.xlsx')
+    return run
+
+
+def web_job(workers):
+    import app as web
+    from jobs import DONE, FAILED
+
+    web.OUTPUT_DIR = os.path.abspath('outputs')
+    client = web.app.test_client()
+
+    def run():
+        with open(SET_LIST, 'rb') as set_list:
+            response = client.post('/generate', data={'mode': 'file', 'set_file': (set_list, SET_LIST)},
+                                   content_type='multipart/form-data')
+        job_id = response.get_json()['job_id']
+        since = 0
+        while True:
+            status = client.get('/jobs/' + job_id + '?since=' + str(since)).get_json()
+            since = status['next']
+            if status['status'] in (DONE, FAILED):
+                break
+            time.sleep(0.05)
+        if status['status'] == FAILED:
+            raise RuntimeError(status['error'])
+    return run
+
+
+def run_child(scenario, workers):
+    """Set the scenario up, then time only the run itself."""
+    import logging
+
+    saves = time_saves()
+    if scenario in ('sheets', 'async'):
+        job = sheets_job(workers, use_async=scenario == 'async')
+    elif scenario in ('inventory', 'bulk'):
+        job = inventory_job(workers, bulk_snapshot=scenario == 'bulk')
+    else:
+        job = web_job(workers)
+
+    start = time.perf_counter()
+    job()
+    elapsed = time.perf_counter() - start
+    logging.shutdown()
+    print(json.dumps({'seconds': elapsed, 'save_seconds': sum(saves), 'peak_rss_mb': peak_rss_mb()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks against a local Bricklink stand-in')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('-s', '--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenarios to run, from ' + ', '.join(SCENARIOS))
+    parser.add_argument('--sets', type=int, default=200, help='sets in the set list')
+    parser.add_argument('--rows', type=int, default=200, help='rows in the Inventory sheet')
+    parser.add_argument('--parts', type=int, default=50, help='distinct parts in the Inventory sheet')
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stand-in delays each response')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--detail-size', type=int, default=500, help='entries in each price_detail')
+    parser.add_argument('--label', default='', help='tag for the results, for example a release')
+    parser.add_argument('-o', '--output', help='append the results to this JSON lines file')
+    options = parser.parse_args()
+
+    if options.child:
+        run_child(options.child, options.workers)
+        return
+
+    from fake_bricklink import FakeBricklink
+
+    fake = FakeBricklink(latency=options.latency, jitter=options.jitter, error_rate=options.error_rate,
+                         throttle_rate=options.throttle_rate, detail_size=options.detail_size)
+    fake.start()
+    print(str(options.sets) + ' sets, ' + str(options.rows) + ' rows, ' + str(options.latency) + 's latency, ' +
+          str(options.detail_size) + ' sales per price guide, ' + str(options.workers) + ' workers')
+    results = []
+    try:
+        for scenario in options.scenarios.split(','):
+            result = run_scenario(fake, scenario.strip(), options)
+            if result:
+                result.update(label=options.label, options=vars(options))
+                results.append(result)
+    finally:
+        fake.stop()
+
+    report(results)
+    if options.output:
+        with open(options.output, 'a') as output:
+            for result in results:
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
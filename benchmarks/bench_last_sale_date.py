@@ -0,0 +1,65 @@
+"""
+Time get_last_sale_date on a large synthetic sold price guide.
+
+Runs three versions over the same price_detail payload and checks that
+they agree:
+  parse-all  - fromisoformat on every sale, as get_last_sale_date used to
+  fast       - get_last_sale_date, comparing the fixed-format strings
+  fallback   - get_last_sale_date with one malformed date in the payload,
+               which makes it parse every sale again
+
+Usage: python benchmarks/bench_last_sale_date.py [sales] [repeats]
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from generate_sheets import get_last_sale_date, parse_last_sale_date
+
+
+def make_sales(count):
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    sales = []
+    for _ in range(count):
+        ordered = start + timedelta(seconds=random.randint(0, 180 * 24 * 60 * 60), milliseconds=random.randint(0, 999))
+        sales.append({
+            'date_ordered': ordered.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (ordered.microsecond // 1000),
+            'unit_price': str(round(random.uniform(10, 300), 4)),
+            'quantity': random.randint(1, 5),
+        })
+    return sales
+
+
+def parse_all(sales):
+    return parse_last_sale_date([sale.get('date_ordered') or '' for sale in sales])
+
+
+def run(name, fn, sales, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn(sales)
+    elapsed = (time.perf_counter() - start) / repeats
+    print('%-10s %8.2f ms  %s' % (name, elapsed * 1000, result))
+    return elapsed, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    sales = make_sales(count)
+    malformed = sales + [{'date_ordered': '27/05/2023 01:09', 'unit_price': '1', 'quantity': 1}]
+
+    print(str(count) + ' sales')
+    slow, expected = run('parse-all', parse_all, sales, repeats)
+    fast, result = run('fast', get_last_sale_date, sales, repeats)
+    _, fallback = run('fallback', get_last_sale_date, malformed, repeats)
+    assert result == expected == fallback
+    print('speedup    %8.1fx' % (slow / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Time the sales statistics of price_stats on a synthetic batch.
+
+Computes the statistics for every item two ways and reports the time each
+takes:
+  per-item   - np.percentile and friends called once per item
+  batch      - price_stats.batch_stats over the whole batch, as add_stats does
+
+Usage: python benchmarks/bench_price_stats.py [items] [sales per item]
+"""
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+from price_stats import TRIM_FRACTION, WINDOWS, batch_stats, sales_columns
+
+
+def make_items(count, sales):
+    today = date.today()
+    items = []
+    for _ in range(count):
+        price_detail = [{
+            'date_ordered': (today - timedelta(days=random.randint(0, 180))).isoformat() + 'T01:09:39.493Z',
+            'unit_price': str(round(random.uniform(10, 300), 4)),
+            'quantity': random.randint(1, 5),
+        } for _ in range(random.randint(0, 2 * sales))]
+        items.append(sales_columns(price_detail))
+    return items
+
+
+def per_item_stats(items):
+    today = np.datetime64(date.today(), 'D')
+    results = []
+    for item in items:
+        price = np.array(item['price'])
+        quantity = np.array(item['quantity'])
+        day = np.array(item['date'], dtype='datetime64[D]')
+        if len(price) == 0:
+            results.append(None)
+            continue
+        trim = int(len(price) * TRIM_FRACTION)
+        stats = {
+            'median': np.percentile(price, 50),
+            'p10': np.percentile(price, 10),
+            'p90': np.percentile(price, 90),
+            'weighted_avg': np.average(price, weights=quantity),
+            'trimmed_mean': np.sort(price)[trim:len(price) - trim].mean(),
+        }
+        for window in WINDOWS:
+            recent = day > today - np.timedelta64(window, 'D')
+            stats['velocity_' + str(window) + 'd'] = quantity[recent].sum() / window
+            stats['volatility_' + str(window) + 'd'] = (price[recent].std() / price[recent].mean()
+                                                        if recent.any() else None)
+        results.append(stats)
+    return results
+
+
+def run(name, compute, items):
+    start = time.perf_counter()
+    compute(items)
+    print('%-9s %7.3fs' % (name, time.perf_counter() - start))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    sales = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    items = make_items(count, sales)
+    print(str(count) + ' items, ' + str(sum(len(item['price']) for item in items)) + ' sales')
+    run('per-item', per_item_stats, items)
+    run('batch', batch_stats, items)
+
+
+if __name__ == '__main__':
+    main()
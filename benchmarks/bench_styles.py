@@ -0,0 +1,90 @@
+"""
+Compare per-cell style objects with the shared named styles.
+
+Builds the same single-sheet workbook three ways and reports build time,
+save time and file size:
+  per-cell   - a new Alignment for every cell, as the writers used to do
+  named      - the shared named styles from sheet_styles
+  streaming  - named styles in write-only mode (--stream)
+
+Usage: python benchmarks/bench_styles.py [rows]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from openpyxl import Workbook
+from openpyxl.styles import Alignment, PatternFill
+
+from sheet_styles import CENTER_STYLE, HEADER_STYLE, HEADER_COLOR, register_styles, styled_row
+
+HEADERS = ['Item', 'Name', 'Category', 'Avg Price', 'Min Price', 'Max Price', 'Quantity', 'Year']
+
+
+def make_rows(count):
+    return [[str(10000 + i) + '-1', 'Set name ' + str(i), 'Category ' + str(i % 40),
+             100 + i % 50, 80 + i % 30, 150 + i % 70, i % 20, 2000 + i % 25] for i in range(count)]
+
+
+def build_per_cell(rows):
+    workbook = Workbook()
+    worksheet = workbook.active
+    for col, value in enumerate(HEADERS, 1):
+        data = worksheet.cell(row=1, column=col, value=value)
+        data.alignment = Alignment(horizontal="center", vertical="center")
+        data.fill = PatternFill(start_color=HEADER_COLOR, end_color=HEADER_COLOR, fill_type="solid")
+    for row, values in enumerate(rows, 2):
+        for col, value in enumerate(values, 1):
+            data = worksheet.cell(row=row, column=col, value=value)
+            data.alignment = Alignment(horizontal="center", vertical="center")
+    return workbook
+
+
+def build_named(rows):
+    workbook = Workbook()
+    register_styles(workbook)
+    worksheet = workbook.active
+    for col, value in enumerate(HEADERS, 1):
+        worksheet.cell(row=1, column=col, value=value).style = HEADER_STYLE
+    for row, values in enumerate(rows, 2):
+        for col, value in enumerate(values, 1):
+            worksheet.cell(row=row, column=col, value=value).style = CENTER_STYLE
+    return workbook
+
+
+def build_streaming(rows):
+    workbook = Workbook(write_only=True)
+    register_styles(workbook)
+    worksheet = workbook.create_sheet('Items')
+    worksheet.append(styled_row(worksheet, HEADERS, HEADER_STYLE))
+    for values in rows:
+        worksheet.append(styled_row(worksheet, values, CENTER_STYLE))
+    return workbook
+
+
+def run(name, build, rows, directory):
+    start = time.perf_counter()
+    workbook = build(rows)
+    built = time.perf_counter()
+    path = os.path.join(directory, name + '.xlsx')
+    workbook.save(path)
+    saved = time.perf_counter()
+    print('%-10s build %6.2fs  save %6.2fs  size %8.1f KB' %
+          (name, built - start, saved - built, os.path.getsize(path) / 1024))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rows = make_rows(count)
+    print(str(count) + ' rows')
+    with tempfile.TemporaryDirectory() as directory:
+        run('per-cell', build_per_cell, rows, directory)
+        run('named', build_named, rows, directory)
+        run('streaming', build_streaming, rows, directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+Local stand-in for the Bricklink store API.
+
+Answers the catalog item, price guide, category, color and store inventory
+endpoints the scripts use, in Bricklink's {"meta": ..., "data": ...}
+envelope, so generate_sheets, inventory_update and the web app can be run
+and timed without touching the real API. Point them at it with base_url in
+the [api] section of config.ini:
+
+    [api]
+    base_url = http://127.0.0.1:8765/
+
+OAuth signatures are not checked, so any credentials will do. Every item
+exists, and its name, category and prices are derived from its number, so
+runs are repeatable. The knobs are:
+  latency, jitter  - seconds every response is delayed by, plus up to jitter
+  error_rate       - fraction of calls answered with a 500 error
+  throttle_rate    - fraction of calls answered with a 429 error
+  detail_size      - entries in the price_detail of each price guide
+
+Usage: python benchmarks/fake_bricklink.py [--port 8765] [--latency 0.05] [--detail-size 10000] ...
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CATEGORIES = 50
+COLORS = ['White', 'Tan', 'Yellow', 'Orange', 'Red', 'Green', 'Blue', 'Brown', 'Light Gray', 'Dark Gray', 'Black']
+
+# (method, path pattern, endpoint name)
+ROUTES = [
+    ('GET', r'items/(?P<item_type>\w+)/(?P<number>[^/]+)/price', 'price_guide'),
+    ('GET', r'items/(?P<item_type>\w+)/(?P<number>[^/]+)', 'item'),
+    ('GET', r'categories', 'category_list'),
+    ('GET', r'categories/(?P<key>\d+)', 'category'),
+    ('GET', r'colors', 'color_list'),
+    ('GET', r'colors/(?P<key>\d+)', 'color'),
+    ('GET', r'inventories', 'inventory_list'),
+    ('POST', r'inventories', 'create_inventory'),
+    ('GET', r'inventories/(?P<key>\d+)', 'inventory'),
+    ('PUT', r'inventories/(?P<key>\d+)', 'update_inventory'),
+    ('DELETE', r'inventories/(?P<key>\d+)', 'delete_inventory'),
+]
+
+
+def seeded(*parts):
+    """A random generator that gives the same numbers for the same parts."""
+    return random.Random(zlib.crc32(':'.join(str(part) for part in parts).encode()))
+
+
+class FakeBricklink:
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 detail_size=100):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.detail_size = detail_size
+
+        # endpoint name -> calls, and the errors that were injected
+        self.calls = Counter()
+        self.errors = Counter()
+        self.inventories = {}
+        self._next_id = 1000
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._server = None
+
+    @property
+    def base_url(self):
+        return 'http://' + self.host + ':' + str(self._server.server_address[1]) + '/'
+
+    def start(self):
+        """Serve on a background thread. Returns the base URL."""
+        self._server = ThreadingHTTPServer((self.host, self.port), make_handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-bricklink', daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def add_listing(self, number, color_id, condition='U', quantity=1, unit_price=1.0, item_type='PART'):
+        """Put a listing in the store inventory. Returns its inventory id."""
+        return self._store({'item': {'no': number, 'type': item_type}, 'color_id': color_id,
+                            'new_or_used': condition, 'quantity': quantity, 'unit_price': unit_price})['inventory_id']
+
+    def dispatch(self, method, path, query, body):
+        """Returns (status code, data) for one request."""
+        for route_method, pattern, name in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, 'No such endpoint: ' + method + ' ' + path
+
+        with self._lock:
+            self.calls[name] += 1
+            roll = self._random.random()
+            if roll < self.error_rate:
+                self.errors[500] += 1
+                return 500, 'Injected server error'
+            if roll < self.error_rate + self.throttle_rate:
+                self.errors[429] += 1
+                return 429, 'Injected throttling'
+
+        return getattr(self, name)(query=query, body=body, **match.groupdict())
+
+    def item(self, item_type, number, query, body):
+        rng = seeded('item', item_type, number)
+        return 200, {'no': number, 'type': item_type, 'name': item_type.title() + ' ' + number,
+                     'category_id': rng.randrange(CATEGORIES), 'year_released': rng.randint(1990, 2024),
+                     'weight': '100.00', 'is_obsolete': False,
+                     'image_url': '//img.bricklink.com/' + number + '.png',
+                     'thumbnail_url': '//img.bricklink.com/t/' + number}
+
+    def price_guide(self, item_type, number, query, body):
+        guide_type = query.get('guide_type', 'stock')
+        condition = query.get('new_or_used', 'N')
+        rng = seeded('price', item_type, number, query.get('color_id'), condition, guide_type)
+        base = rng.uniform(1, 300)
+        today = date.today()
+        detail = []
+        for _ in range(self.detail_size):
+            entry = {'quantity': rng.randint(1, 5), 'unit_price': '%.4f' % (base * rng.uniform(0.5, 1.5)),
+                     'seller_country_code': 'US', 'buyer_country_code': 'US'}
+            if guide_type == 'sold':
+                ordered = today - timedelta(days=rng.randrange(180))
+                entry['date_ordered'] = ordered.isoformat() + 'T%02d:%02d:%02d.%03dZ' % (
+                    rng.randrange(24), rng.randrange(60), rng.randrange(60), rng.randrange(1000))
+            else:
+                entry['shipping_available'] = True
+            detail.append(entry)
+        prices = [float(entry['unit_price']) for entry in detail] or [base]
+        quantity = sum(entry['quantity'] for entry in detail)
+        return 200, {'item': {'no': number, 'type': item_type}, 'new_or_used': condition, 'currency_code': 'USD',
+                     'min_price': '%.4f' % min(prices), 'max_price': '%.4f' % max(prices),
+                     'avg_price': '%.4f' % (sum(prices) / len(prices)),
+                     'qty_avg_price': '%.4f' % (sum(prices) / len(prices)),
+                     'unit_quantity': len(detail), 'total_quantity': quantity, 'price_detail': detail}
+
+    def category_list(self, query, body):
+        return 200, [{'category_id': category_id, 'category_name': 'Category ' + str(category_id), 'parent_id': 0}
+                     for category_id in range(CATEGORIES)]
+
+    def category(self, key, query, body):
+        return 200, {'category_id': int(key), 'category_name': 'Category ' + key, 'parent_id': 0}
+
+    def color_list(self, query, body):
+        return 200, [{'color_id': color_id, 'color_name': name, 'color_code': 'FFFFFF', 'color_type': 'Solid'}
+                     for color_id, name in enumerate(COLORS, 1)]
+
+    def color(self, key, query, body):
+        if not 1 <= int(key) <= len(COLORS):
+            return 404, 'No such color'
+        return 200, {'color_id': int(key), 'color_name': COLORS[int(key) - 1], 'color_code': 'FFFFFF',
+                     'color_type': 'Solid'}
+
+    def inventory_list(self, query, body):
+        with self._lock:
+            return 200, list(self.inventories.values())
+
+    def create_inventory(self, query, body):
+        return 200, self._store(body)
+
+    def _store(self, body):
+        with self._lock:
+            self._next_id += 1
+            listing = dict(body, inventory_id=self._next_id)
+            listing.setdefault('quantity', 1)
+            self.inventories[self._next_id] = listing
+            return listing
+
+    def inventory(self, key, query, body):
+        with self._lock:
+            listing = self.inventories.get(int(key))
+        return (200, listing) if listing else (404, 'No such inventory')
+
+    def update_inventory(self, key, query, body):
+        with self._lock:
+            listing = self.inventories.get(int(key))
+            if listing is None:
+                return 404, 'No such inventory'
+            # Bricklink's quantity in an update is a change, not a new total
+            quantity = body.pop('quantity', 0) or 0
+            listing.update(body)
+            listing['quantity'] += int(quantity)
+            return 200, listing
+
+    def delete_inventory(self, key, query, body):
+        with self._lock:
+            if self.inventories.pop(int(key), None) is None:
+                return 404, 'No such inventory'
+        return 200, {}
+
+
+def make_handler(fake):
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep connections alive like the real API, so client connection
+        # pools are exercised. The headers and body go out in separate
+        # writes, so without TCP_NODELAY every response would wait for a
+        # delayed ACK.
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def handle_request(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else {}
+            url = urlparse(self.path)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            delay = fake.latency + (fake.jitter and random.uniform(0, fake.jitter))
+            if delay:
+                time.sleep(delay)
+
+            code, data = fake.dispatch(self.command, url.path.strip('/'), query, body)
+            if code == 200:
+                envelope = {'meta': {'code': 200, 'message': 'OK', 'description': 'OK'}, 'data': data}
+            else:
+                envelope = {'meta': {'code': code, 'message': data, 'description': data}, 'data': {}}
+            payload = json.dumps(envelope).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Bricklink API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every response is delayed by')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds of delay')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls that fail with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of calls that fail with a 429')
+    parser.add_argument('--detail-size', type=int, default=100, help='entries in each price_detail')
+    args = parser.parse_args()
+
+    fake = FakeBricklink(args.host, args.port, args.latency, args.jitter, args.error_rate, args.throttle_rate,
+                         args.detail_size)
+    print('Serving the Bricklink API on ' + fake.start())
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.stop()
+        print('Calls: ' + json.dumps(dict(fake.calls), sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
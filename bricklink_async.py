@@ -0,0 +1,152 @@
+"""
+Asyncio client for the Bricklink API.
+
+bricklink_py is built on requests, so every call in flight holds a thread.
+This client signs the same OAuth1 requests itself and sends them with
+aiohttp, so a single event loop can keep hundreds of price guide requests
+open at once. Responses are handled the same way as in bricklink_py and
+errors are raised as bricklink_py's exceptions, so the rate limiter and the
+callers treat both clients alike. HTTP errors without a Bricklink body are
+raised as a BricklinkError with the HTTP status, and dropped connections
+and timeouts as ConnectionFailed, an OSError, so both are retried like
+their requests counterparts.
+
+Only the catalog and category calls generate_sheets needs are implemented.
+The client must be created, used and closed on the same event loop.
+"""
+import asyncio
+from urllib.parse import urlencode
+
+import aiohttp
+from bricklink_py import utils
+from bricklink_py.utils import AuthenticationError, BricklinkError, RateLimitError, ResourceNotFoundError
+
+# Connections kept open to Bricklink at the same time
+DEFAULT_MAX_CONNECTIONS = 100
+
+# Seconds to connect, and to wait for each read of a response. Time spent
+# waiting for a free connection doesn't count.
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+
+
+class ConnectionFailed(OSError):
+    """A request that never got a complete response, like requests' ConnectionError."""
+
+
+class AsyncBricklink:
+
+    def __init__(self, oauth_client, max_connections=DEFAULT_MAX_CONNECTIONS, timeout=DEFAULT_TIMEOUT):
+        """oauth_client is an oauthlib.oauth1.Client holding the credentials."""
+        self._oauth = oauth_client
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._session = None
+        self.catalog_item = CatalogItem(self)
+        self.category = Category(self)
+
+    @classmethod
+    def from_session(cls, session, max_connections=DEFAULT_MAX_CONNECTIONS):
+        """Sign with the same OAuth1 credentials as a bricklink_py session."""
+        return cls(session.oauth_session.auth.client, max_connections)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get(self, uri, params=None):
+        """GET uri below the API base URL and return the response data."""
+        url = utils.API_BASE_URL + uri
+        # Like requests, leave out parameters that are None
+        query = urlencode({key: value for key, value in (params or {}).items() if value is not None})
+        if query:
+            url += '?' + query
+        # The signature covers the query string, so sign the final URL
+        url, headers, _ = self._oauth.sign(url, http_method='GET')
+        # The client shared with requests_oauthlib signs to bytes
+        url = text(url)
+        headers = {text(key): text(value) for key, value in headers.items()}
+
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._max_connections)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        try:
+            async with self._session.get(url, headers=headers) as response:
+                return await handle_response(response)
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            raise ConnectionFailed('GET ' + uri + ' failed: ' + (str(e) or type(e).__name__)) from e
+
+
+def text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+async def handle_response(response):
+    """Async version of bricklink_py.utils.handle_response."""
+    if response.status == 204:
+        return {}
+
+    try:
+        response_data = await response.json(content_type=None)
+    except ValueError:
+        if response.status >= 400:
+            raise BricklinkError(response.status, response.reason or 'HTTP error')
+        return await response.text()
+
+    if "meta" in response_data and response_data["meta"]["code"] not in (200, 201, 204):
+        error_code = response_data["meta"]["code"]
+        error_message = response_data["meta"].get("message", "Unknown error")
+
+        if error_code == 404:
+            raise ResourceNotFoundError(error_code, error_message, response_data)
+        elif error_code == 429:
+            raise RateLimitError(error_code, "Rate limit exceeded", response_data)
+        elif error_code in (401, 403):
+            raise AuthenticationError(error_code, error_message, response_data)
+        else:
+            raise BricklinkError(error_code, error_message, response_data)
+
+    if "data" in response_data:
+        return response_data["data"]
+
+    return response_data
+
+
+class CatalogItem:
+
+    def __init__(self, client):
+        self._client = client
+
+    async def get_item(self, type, no):
+        return await self._client.get(f"items/{type}/{no}")
+
+    async def get_price_guide(self, type, no, color_id=None, guide_type="stock", new_or_used="N",
+                              country_code=None, region=None, currency_code=None, vat="N"):
+        params = {
+            "color_id": color_id,
+            "guide_type": guide_type,
+            "new_or_used": new_or_used,
+            "country_code": country_code,
+            "region": region,
+            "currency_code": currency_code,
+            "vat": vat,
+        }
+        return await self._client.get(f"items/{type}/{no}/price", params)
+
+
+class Category:
+
+    def __init__(self, client):
+        self._client = client
+
+    async def get_category_list(self):
+        return await self._client.get("categories")
+
+    async def get_category(self, category_id):
+        return await self._client.get(f"categories/{category_id}")
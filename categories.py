@@ -0,0 +1,111 @@
+"""
+Process-wide lookup table of Bricklink categories.
+
+Bricklink only has a few hundred categories, so rather than calling
+get_category once per item the whole list is fetched in one call and kept
+in memory for the life of the process. The list is also kept in the
+metadata cache, so warm runs don't need to fetch it at all. Categories that
+are missing from the list are looked up on first use.
+
+The index is module level, so the Flask app shares it across requests.
+"""
+import logging
+import threading
+from concurrent.futures import Future
+
+import metadata_cache
+from metadata_cache import category_key
+
+CATEGORY_LIST_KEY = 'categories'
+
+
+class CategoryIndex:
+
+    def __init__(self):
+        self._categories = {}
+        # category_id -> Future of a lookup in progress
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def load(self, categories):
+        """Add a list of category records, as returned by get_category_list."""
+        with self._lock:
+            for category in categories:
+                self._categories[category['category_id']] = category
+            self.loaded = True
+
+    def preload(self, fetch_list):
+        """
+        Fill the index from the full category list unless that has already
+        been done in this process. fetch_list() should return the list.
+        A failed preload is not fatal; categories are then looked up one at
+        a time as they are needed.
+        """
+        if self.loaded:
+            return
+        try:
+            categories = metadata_cache.get_cache().get_or_fetch(CATEGORY_LIST_KEY, fetch_list)
+        except Exception as e:
+            logging.warning('Could not preload categories: ' + str(e))
+            return
+        self.load(categories)
+        logging.debug('Loaded ' + str(len(self._categories)) + ' categories')
+
+    def get(self, category_id, fetch):
+        """
+        Return the category record for category_id, calling fetch() to look
+        it up if it isn't known yet. Concurrent workers asking for the same
+        category wait for one lookup, and lookups of different categories
+        don't wait for each other.
+        """
+        category = self._categories.get(category_id)
+        if category is not None:
+            return category
+
+        # The lock is never held while fetching, only while claiming the lookup
+        with self._lock:
+            category = self._categories.get(category_id)
+            if category is not None:
+                return category
+            pending = self._pending.get(category_id)
+            if pending is None:
+                pending = self._pending[category_id] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return pending.result()
+
+        try:
+            category = metadata_cache.get_cache().get_or_fetch(category_key(category_id), fetch)
+        except BaseException as e:
+            # The waiting workers fail the same way, and the next call tries again
+            with self._lock:
+                del self._pending[category_id]
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            self._categories[category_id] = category
+            del self._pending[category_id]
+        pending.set_result(category)
+        return category
+
+    async def get_async(self, category_id, fetch):
+        """
+        get for the async client, where fetch is a coroutine function.
+        The lock isn't held while fetching so the event loop never blocks on
+        it; after a preload a category is very rarely missing anyway.
+        """
+        category = self._categories.get(category_id)
+        if category is None:
+            category = await metadata_cache.get_cache().get_or_fetch_async(category_key(category_id), fetch)
+            with self._lock:
+                self._categories[category_id] = category
+        return category
+
+    def __len__(self):
+        return len(self._categories)
+
+
+category_index = CategoryIndex()
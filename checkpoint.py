@@ -0,0 +1,81 @@
+"""
+Checkpoint journal for set list runs.
+
+Each set's details are appended to a JSONL file as soon as they have been
+fetched, so a run that fails part way through loses nothing. Running again
+with --resume reads the journal back, only fetches the sets that are not in
+it and then builds the workbook as usual. The journal is removed once the
+workbook has been saved.
+
+Only the entries loaded from an earlier run are kept in memory. Sets
+recorded by this run go straight to the file, so a streamed run's memory
+doesn't grow with the number of sets.
+"""
+import json
+import logging
+import os
+import threading
+
+
+def journal_path(xls_filename):
+    return os.path.splitext(xls_filename)[0] + '.journal.jsonl'
+
+
+class Journal:
+
+    def __init__(self, path):
+        self.path = path
+        # The sets fetched by an earlier run, loaded with resume
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    def open(self, resume=False):
+        """
+        Open the journal for appending. With resume the entries of an
+        earlier run are loaded first, otherwise any old journal is discarded.
+        """
+        if resume:
+            self.entries = self.load()
+            if self.entries:
+                logging.info('Resuming: ' + str(len(self.entries)) + ' sets already fetched')
+            mode = 'a'
+        else:
+            mode = 'w'
+        self._file = open(self.path, mode)
+        return self
+
+    def load(self):
+        entries = {}
+        if not os.path.isfile(self.path):
+            return entries
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be cut short if the run was killed
+                    logging.warning('Skipping unreadable journal line')
+                    continue
+                entries[entry['set']] = entry['details']
+        return entries
+
+    def get(self, number):
+        return self.entries.get(number)
+
+    def record(self, number, details):
+        line = json.dumps({'set': number, 'details': details}) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -0,0 +1,113 @@
+"""
+Process-wide registry of Bricklink colors.
+
+colors.json maps each color id, as a string, to {"Name": ...}. The registry
+reads it once per process and keeps two dicts, so a color's name and a
+name's color id are both a dict lookup. Sheets can give a row's color as
+an id or as its name.
+
+The file can be rebuilt from the catalog with get_color_list, which is
+only needed when Bricklink adds colors.
+
+The registry is module level, so the Flask app shares it across requests.
+"""
+import json
+import logging
+import os
+import threading
+
+COLORS_FILE = 'colors.json'
+
+
+def normalize(name):
+    return ' '.join(str(name).split()).casefold()
+
+
+class ColorRegistry:
+
+    def __init__(self):
+        self._names = {}
+        self._ids = {}
+        self._lock = threading.Lock()
+        self.path = None
+
+    @property
+    def loaded(self):
+        return self.path is not None
+
+    def load(self, colors):
+        """Replace the registry with a {color id: name} dict."""
+        names = {int(color_id): name for color_id, name in colors.items()}
+        ids = {normalize(name): color_id for color_id, name in names.items()}
+        with self._lock:
+            self._names = names
+            self._ids = ids
+
+    def load_file(self, path=COLORS_FILE):
+        """Read a colors.json file. Raises IOError if it can't be read."""
+        with open(path) as colors_file:
+            colors = json.load(colors_file)
+        self.load({color_id: entry['Name'] for color_id, entry in colors.items()})
+        self.path = path
+        logging.debug('Loaded ' + str(len(self._names)) + ' colors from ' + path)
+
+    def ensure_loaded(self, path=COLORS_FILE):
+        """Read path unless a colors file has already been read in this process."""
+        if not self.loaded:
+            self.load_file(path)
+
+    def refresh(self, fetch_list, path=COLORS_FILE):
+        """
+        Rebuild the registry and path from the catalog. fetch_list() should
+        return the list from get_color_list.
+        """
+        colors = {int(color['color_id']): color['color_name'] for color in fetch_list()}
+        self.load(colors)
+        self.path = path
+        save(path, colors)
+        logging.info('Saved ' + str(len(colors)) + ' colors to ' + path)
+
+    def name(self, color_id):
+        """The name of a color id, or None if it isn't known."""
+        try:
+            return self._names.get(int(color_id))
+        except (TypeError, ValueError):
+            return None
+
+    def id(self, name):
+        """The id of a color name, ignoring case and extra spaces, or None."""
+        return self._ids.get(normalize(name))
+
+    def resolve(self, value):
+        """
+        The color id for a spreadsheet cell, which may hold the id or the
+        name of the color. Returns None for an empty cell or an unknown color.
+        """
+        if value is None or value == '':
+            return None
+        if isinstance(value, (int, float)) or str(value).strip().isdigit():
+            color_id = int(value)
+            return color_id if color_id in self._names else None
+        return self.id(value)
+
+    def as_dict(self):
+        """{color id: name} for every color, in id order."""
+        return dict(sorted(self._names.items()))
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, color_id):
+        return self.name(color_id) is not None
+
+
+def save(path, colors):
+    """Write {color id: name} in the colors.json format, replacing path in one step."""
+    data = {str(color_id): {'Name': name} for color_id, name in sorted(colors.items())}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as colors_file:
+        json.dump(data, colors_file, indent=3)
+    os.replace(tmp_path, path)
+
+
+color_registry = ColorRegistry()
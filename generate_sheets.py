@@ -1,26 +1,76 @@
 """
 This is neat little utility that gets pricing for Lego sets.
 """
-import json
 import argparse
 import sys
 import logging
 import os
 from os import stat
 from os.path import exists
-from bricklink_py import Bricklink
 import html
 from html.parser import HTMLParser
 from openpyxl import load_workbook, Workbook
-from openpyxl.styles import Alignment,Font,PatternFill
-import configparser
+import asyncio
+import contextvars
+import functools
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+import metadata_cache
+import payload_archive
+import price_history
+from profiling import profiler
+from price_stats import DEFAULT_BATCH_SIZE, STAT_HEADERS, add_stats, sales_columns, stat_values
+from rate_limit import limiter, QuotaExceeded
+from metadata_cache import item_key
+from categories import category_index
+from checkpoint import Journal, journal_path
+from refresh import IncrementalRefresh
+from sheet_styles import CENTER_STYLE, HEADER_STYLE, register_styles, styled_row
+import session_provider
+from log_utils import LazyJSON
+from bricklink_async import AsyncBricklink, DEFAULT_MAX_CONNECTIONS
 
 logging.basicConfig(
 format='%(asctime)s %(levelname)-8s %(message)s',
 level=logging.DEBUG,
 datefmt='%Y-%m-%d %H:%M:%S')
 
+class FetchFailed(Exception):
+    """A set in a single sheet run whose details could not be fetched."""
+
+
+# Number of sets fetched at the same time when processing a set list
+DEFAULT_WORKERS = 8
+
+# Requests getDetails makes at the same time for one set: the two price
+# guides and the catalog item
+REQUESTS_PER_SET = 3
+
+# Pool for the independent requests made inside a single getDetails call.
+# Kept separate from the per-set pool in fetch_details so that a set waiting
+# on its own requests can never starve them of a thread. fetch_details
+# makes its own, sized for its number of workers; this one is for single
+# sets.
+_request_pool = ThreadPoolExecutor(max_workers=DEFAULT_WORKERS * REQUESTS_PER_SET,
+                                   thread_name_prefix='bricklink-request')
+
+
+# Bricklink's date_ordered format with every digit replaced by 0. Dates in
+# this format sort as strings in time order.
+DATE_TEMPLATE = b'0000-00-00T00:00:00.000Z'
+TO_ZEROS = bytes.maketrans(b'123456789', b'000000000')
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """
+    Submit fn to executor so it runs in a copy of the caller's context.
+    Pool threads don't inherit context variables, and the web app relies
+    on them to send log records to the job that made them.
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args, **kwargs)
+
 
 def get_last_sale_date(sales: dict) -> str | None:
     """
@@ -43,12 +93,36 @@ def get_last_sale_date(sales: dict) -> str | None:
     get_last_sale_date(sales)
     # → '2023-12-11T18:44:02.100Z'
     """
+    items = sales.values() if isinstance(sales, dict) else sales
+    raws = list(filter(None, [sale.get('date_ordered') for sale in items]))
+    if not raws:
+        return None
+
+    # Fast path: when every date has the fixed format, which turning the
+    # digits to zeros checks in one pass, the latest is the largest string.
+    # It is still parsed in case its digits are out of range.
+    try:
+        fixed = ''.join(raws).encode('ascii').translate(TO_ZEROS) == DATE_TEMPLATE * len(raws)
+    except (TypeError, UnicodeEncodeError):
+        fixed = False
+    if fixed:
+        latest_raw = max(raws)
+        try:
+            datetime.fromisoformat(latest_raw.replace('Z', '+00:00'))
+            return latest_raw
+        except ValueError:
+            pass
+
+    return parse_last_sale_date(raws)
+
+"""
+The slow path of get_last_sale_date: parse every date and keep the latest.
+"""
+def parse_last_sale_date(raws):
     latest_dt  = None
     latest_raw = None
 
-    items = sales.values() if isinstance(sales, dict) else sales
-    for sale in items:
-        raw = sale.get('date_ordered', '')
+    for raw in raws:
         if not raw:
             continue
         try:
@@ -64,36 +138,114 @@ def get_last_sale_date(sales: dict) -> str | None:
     return latest_raw
 
 """
-This calls the API functions to get the data.
+This calls the API functions to get the data. The requests for the set are
+made in parallel on request_pool. The raw price guides are archived unless
+archive is False.
 """
-def getDetails(session, set_number):
+def getDetails(session, set_number, request_pool=None, archive=True):
     logging.debug("Getting details for " + str(set_number))
-    h_parse = html.parser
+    request_pool = request_pool or _request_pool
 
     if set_number == "40158":
         item_type = "GEAR"
     else:
         item_type = "SET"
 
+    current_future = submit_in_context(request_pool, limiter.call, session.catalog_item.get_price_guide,
+                                       item_type, set_number, new_or_used="N", country_code="US",
+                                       region="north_america")
+    past_future = submit_in_context(request_pool, limiter.call, session.catalog_item.get_price_guide,
+                                    item_type, set_number, new_or_used="N", guide_type="sold",
+                                    country_code="US", region="north_america")
+    cache = metadata_cache.get_cache()
+    item_future = submit_in_context(request_pool, cache.get_or_fetch, item_key(item_type, set_number),
+                                    lambda: limiter.call(session.catalog_item.get_item, item_type, set_number))
+
     try:
-        current_items = session.catalog_item.get_price_guide(item_type, set_number, new_or_used="N",
-                                                             country_code="US", region="north_america")
+        current_items = current_future.result()
+        past_sales = past_future.result()
+    except QuotaExceeded:
+        raise
+    except Exception as e:
+        logging.exception("Failed to get price guide for item" + str(e))
+        return {}
+
+    logging.debug(LazyJSON(current_items))
+    logging.debug(LazyJSON(past_sales))
+    if archive:
+        archive_payloads(item_type, set_number, current_items, past_sales)
+
+    type_data = item_future.result()
+
+    logging.debug(LazyJSON(type_data))
+
+    category_data = category_index.get(type_data['category_id'],
+                                       lambda: limiter.call(session.category.get_category, type_data['category_id']))
+    logging.debug(LazyJSON(category_data))
+
+    with profiler.stage('transform'):
+        return build_details(set_number, current_items, past_sales, type_data, category_data)
 
-        past_sales = session.catalog_item.get_price_guide(item_type, set_number, new_or_used="N", \
-                                                          guide_type="sold", country_code="US", region="north_america")
+"""
+The same as getDetails, using the asyncio client. The three requests for a
+set are awaited together, so many sets can be in flight on one thread.
+"""
+async def get_details_async(client, set_number):
+    logging.debug("Getting details for " + str(set_number))
+
+    if set_number == "40158":
+        item_type = "GEAR"
+    else:
+        item_type = "SET"
+
+    current_task = asyncio.ensure_future(limiter.call_async(client.catalog_item.get_price_guide,
+                                                            item_type, set_number, new_or_used="N",
+                                                            country_code="US", region="north_america"))
+    past_task = asyncio.ensure_future(limiter.call_async(client.catalog_item.get_price_guide,
+                                                         item_type, set_number, new_or_used="N",
+                                                         guide_type="sold", country_code="US",
+                                                         region="north_america"))
+    cache = metadata_cache.get_cache()
+    item_task = asyncio.ensure_future(cache.get_or_fetch_async(
+        item_key(item_type, set_number),
+        lambda: limiter.call_async(client.catalog_item.get_item, item_type, set_number)))
+
+    try:
+        current_items = await current_task
+        past_sales = await past_task
     except Exception as e:
+        # Nothing is going to wait for the other requests
+        for task in (current_task, past_task, item_task):
+            task.cancel()
+        if isinstance(e, QuotaExceeded):
+            raise
         logging.exception("Failed to get price guide for item" + str(e))
         return {}
 
-    logging.debug(json.dumps(current_items, indent=4, sort_keys=True))
-    logging.debug(json.dumps(past_sales, indent=4, sort_keys=True))
+    logging.debug(LazyJSON(current_items))
+    logging.debug(LazyJSON(past_sales))
+    # Compressing and writing would hold up every other request on the loop.
+    # to_thread runs it in a copy of the context, so its log lines still
+    # reach the web app job.
+    await asyncio.to_thread(archive_payloads, item_type, set_number, current_items, past_sales)
+
+    type_data = await item_task
 
-    type_data = session.catalog_item.get_item(item_type, set_number)
+    logging.debug(LazyJSON(type_data))
 
-    logging.debug(json.dumps(type_data, indent=4, sort_keys=True))
+    category_data = await category_index.get_async(
+        type_data['category_id'],
+        lambda: limiter.call_async(client.category.get_category, type_data['category_id']))
+    logging.debug(LazyJSON(category_data))
 
-    category_data = session.category.get_category(type_data['category_id'])
-    logging.debug(json.dumps(category_data, indent=4, sort_keys=True))
+    with profiler.stage('transform'):
+        return build_details(set_number, current_items, past_sales, type_data, category_data)
+
+"""
+Build the details of a set from its API responses.
+"""
+def build_details(set_number, current_items, past_sales, type_data, category_data):
+    h_parse = html.parser
 
     elem_data = {}
     elem_data[set_number] = {}
@@ -103,15 +255,24 @@ def getDetails(session, set_number):
     elem_data[set_number]['current']['avg'] = round(int(float(current_items['avg_price'])))
     elem_data[set_number]['current']['max'] = round(int(float(current_items['max_price'])))
     elem_data[set_number]['current']['min'] = round(int(float(current_items['min_price'])))
+    # Bricklink's exact prices, for the price history; the sheets use the whole numbers
+    elem_data[set_number]['current']['avg_price'] = float(current_items['avg_price'])
+    elem_data[set_number]['current']['max_price'] = float(current_items['max_price'])
+    elem_data[set_number]['current']['min_price'] = float(current_items['min_price'])
     elem_data[set_number]['current']['quantity'] = current_items['unit_quantity']
     elem_data[set_number]['current']['currency'] = current_items['currency_code']
     elem_data[set_number]['past'] = {}
     elem_data[set_number]['past']['avg'] = round(int(float(past_sales['avg_price'])))
     elem_data[set_number]['past']['max'] = round(int(float(past_sales['max_price'])))
     elem_data[set_number]['past']['min'] = round(int(float(past_sales['min_price'])))
+    elem_data[set_number]['past']['avg_price'] = float(past_sales['avg_price'])
+    elem_data[set_number]['past']['max_price'] = float(past_sales['max_price'])
+    elem_data[set_number]['past']['min_price'] = float(past_sales['min_price'])
     elem_data[set_number]['past']['quantity'] = past_sales['unit_quantity']
     elem_data[set_number]['past']['currency'] = past_sales['currency_code']
     elem_data[set_number]['past']['last_sale_date'] = get_last_sale_date(past_sales['price_detail'])
+    # The raw sales, for price_stats.add_stats
+    elem_data[set_number]['past']['sales'] = sales_columns(past_sales['price_detail'], set_number)
     elem_data[set_number]['year'] = type_data['year_released']
     elem_data[set_number]['image'] = type_data['image_url']
     elem_data[set_number]['thumbnail'] = type_data['thumbnail_url']
@@ -119,6 +280,163 @@ def getDetails(session, set_number):
 
     return elem_data
 
+"""
+Archive the raw price guides of a fetched set. Replayed responses are
+already in the archive from the run that recorded them.
+"""
+def archive_payloads(item_type, set_number, current_items, past_sales):
+    if limiter.offline:
+        return
+    with profiler.stage('archive'):
+        payload_archive.get_archive().append(item_type, set_number, current_items, past_sales)
+
+"""
+Add a set's details to the price history as today's snapshot. Sets reused
+from the history by refresh are already in it, and replayed responses are
+not today's prices, so neither is recorded again.
+"""
+def record_history(history, key, details):
+    if 'snapshot_date' in details or limiter.offline:
+        return
+    with profiler.stage('history'):
+        history.record(key, details)
+
+"""
+How many fetched sets the writers let add_stats hold back. Live fetches
+are kept to one fetch window, so rows, log lines and failed sets show up
+as sets arrive instead of after hundreds of them. Replayed responses all
+arrive at once and get the big batches.
+"""
+def stats_batch_size(max_workers):
+    if limiter.offline:
+        return DEFAULT_BATCH_SIZE
+    return max_workers * 2
+
+"""
+Read the set numbers from a set list, skipping blank lines.
+"""
+def read_set_list(file_handler):
+    return [line.strip() for line in file_handler if line.strip()]
+
+"""
+Get the details for a set and record them in the journal straight away, so
+they survive even if the run fails before the writer gets to them.
+"""
+def fetch_and_record(session, number, journal, request_pool=None):
+    res = getDetails(session, number, request_pool)
+    if res:
+        journal.record(number, res)
+    return res
+
+"""
+Fetch the details for many sets at once.
+
+Yields (set_number, details) pairs in the same order as set_numbers, so the
+sheet writers can keep writing rows in input order. At most max_workers sets
+are fetched at the same time and only a small window of results is held
+in memory ahead of the writer. Sets already in the journal are not fetched
+again, and neither are sets that refresh finds fresh in the price history.
+
+The request pool and the session's connection pool are sized for
+max_workers, so raising it keeps more requests in flight.
+"""
+def fetch_details(session, set_numbers, max_workers=DEFAULT_WORKERS, journal=None, refresh=None):
+    session_provider.ensure_pool_size(session, max_workers * REQUESTS_PER_SET)
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bricklink-set')
+    request_pool = ThreadPoolExecutor(max_workers=max_workers * REQUESTS_PER_SET,
+                                      thread_name_prefix='bricklink-request')
+    pending = deque()
+    try:
+        for number in set_numbers:
+            cached = journal.get(number) if journal else None
+            if not cached and refresh:
+                cached = refresh.reuse(number)
+            if cached:
+                future = Future()
+                future.set_result(cached)
+            elif journal:
+                future = submit_in_context(executor, fetch_and_record, session, number, journal, request_pool)
+            else:
+                future = submit_in_context(executor, getDetails, session, number, request_pool)
+            pending.append((number, future))
+            if len(pending) >= max_workers * 2:
+                number, future = pending.popleft()
+                yield number, future.result()
+
+        while pending:
+            number, future = pending.popleft()
+            yield number, future.result()
+    finally:
+        # Drop queued sets if the writer stopped early
+        executor.shutdown(wait=True, cancel_futures=True)
+        request_pool.shutdown(wait=True)
+
+"""
+fetch_details for the asyncio client.
+
+Yields the same (set_number, details) pairs in input order. All requests
+run on one event loop, with at most max_in_flight sets being fetched at
+the same time.
+"""
+async def fetch_details_async(client, set_numbers, max_in_flight=DEFAULT_WORKERS, journal=None, refresh=None):
+    slots = asyncio.Semaphore(max_in_flight)
+
+    async def fetch(number):
+        async with slots:
+            res = await get_details_async(client, number)
+        if res and journal:
+            journal.record(number, res)
+        return res
+
+    pending = deque()
+    try:
+        for number in set_numbers:
+            cached = journal.get(number) if journal else None
+            if not cached and refresh:
+                cached = refresh.reuse(number)
+            if cached:
+                task = asyncio.get_running_loop().create_future()
+                task.set_result(cached)
+            else:
+                task = asyncio.ensure_future(fetch(number))
+            pending.append((number, task))
+            if len(pending) >= max_in_flight * 2:
+                number, task = pending.popleft()
+                yield number, await task
+
+        while pending:
+            number, task = pending.popleft()
+            yield number, await task
+    finally:
+        # Drop queued sets if the writer stopped early
+        for number, task in pending:
+            task.cancel()
+        await asyncio.gather(*(task for number, task in pending), return_exceptions=True)
+
+"""
+Drive fetch_details_async from synchronous code, so its results can feed
+the existing sheet writers. Takes the same arguments as fetch_details and
+signs requests with the credentials of session.
+
+The event loop only runs while the writer waits for the next set, which
+is fine because writing a row takes far less time than a request.
+"""
+def fetch_details_with_async_client(session, set_numbers, max_workers=DEFAULT_WORKERS, journal=None,
+                                    refresh=None):
+    loop = asyncio.new_event_loop()
+    client = AsyncBricklink.from_session(session, max(DEFAULT_MAX_CONNECTIONS, max_workers * REQUESTS_PER_SET))
+    details = fetch_details_async(client, set_numbers, max_workers, journal, refresh)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(details.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(details.aclose())
+        loop.run_until_complete(client.close())
+        loop.close()
+
 """
 This prints stuff to the screen.
 """
@@ -137,6 +455,10 @@ def print_details(element_data, number):
     logging.info("     Min: " + str(element_data['past']['min']) + " " + element_data['past']['currency'])
     logging.info("     Quantity avail: " + str(element_data['past']['quantity']))
     logging.info("     Last Sale Date: " + str(element_data['past']['last_sale_date']))
+    if element_data.get('stats'):
+        logging.info("  Sales Statistics: ")
+        for header, value in zip(STAT_HEADERS, stat_values(element_data)):
+            logging.info("     " + header + ": " + str(value))
     logging.info("  Year Released: " + str(element_data['year']))
     logging.info("  Image: " + str(element_data['image']))
     logging.info("  Thumbnail: " + str(element_data['thumbnail']))
@@ -157,6 +479,8 @@ def create_wookbook(xls_filename):
         logging.error('Could not load excel file!' + str(exception))
         sys.exit(1)
 
+    register_styles(workbook)
+
     return workbook
 
 """
@@ -179,14 +503,11 @@ def add_worksheet(workbook, item_name):
         worksheet.column_dimensions['E'].width = 20
         worksheet.column_dimensions['F'].width = 20
 
-        header_color = "00C0C0C0"
         data = worksheet.cell(row=2, column=2, value="Name")
-        data.fill = PatternFill(start_color=header_color, end_color=header_color, fill_type="solid")
-        data.alignment = Alignment(horizontal="center", vertical="center")
+        data.style = HEADER_STYLE
 
         data = worksheet.cell(row=3, column=2, value="Category")
-        data.fill = PatternFill(start_color=header_color, end_color=header_color, fill_type="solid")
-        data.alignment = Alignment(horizontal="center", vertical="center")
+        data.style = HEADER_STYLE
 
         xls_headers = ['Date', 'Avg Price', 'Min Price', 'Max Price', 'Quantity']
 
@@ -195,13 +516,24 @@ def add_worksheet(workbook, item_name):
         for headers in xls_headers:
             #worksheet.write(row, col+col_adjust, headers, header_format)
             data = worksheet.cell(row=_row, column=_col+col_adjust, value=headers)
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data.fill = PatternFill(start_color=header_color,
-                                    end_color=header_color, fill_type="solid")
+            data.style = HEADER_STYLE
             col_adjust += 1
 
     return worksheet
 
+"""
+Find the row after the last filled cell in column, starting at first_row.
+
+Uses the worksheet's max_row rather than scanning down from the top, so
+appending costs the same however long the sheet is. max_row may count
+trailing rows that only have formatting, so step back over empty cells.
+"""
+def next_free_row(worksheet, first_row, column=2):
+    row = worksheet.max_row
+    while row >= first_row and worksheet.cell(row=row, column=column).value is None:
+        row -= 1
+    return max(row + 1, first_row)
+
 def create_wookbook_and_sheet(xls_filename):
     workbook = create_wookbook(xls_filename)
 
@@ -221,92 +553,104 @@ def create_wookbook_and_sheet(xls_filename):
     worksheet.column_dimensions['G'].width = 20
     worksheet.column_dimensions['F'].width = 20
 
-    header_color = "00C0C0C0"
+    for column in 'IJKLMNO':
+        worksheet.column_dimensions[column].width = 15
 
-    xls_headers = ['Item', 'Name', 'Category', 'Avg Price', 'Min Price', 'Max Price', 'Quantity', 'Year']
+    xls_headers = ['Item', 'Name', 'Category', 'Avg Price', 'Min Price', 'Max Price', 'Quantity', 'Year'] + STAT_HEADERS
 
     _row = 5
     col_adjust = 0
     for headers in xls_headers:
         #worksheet.write(row, col+col_adjust, headers, header_format)
         data = worksheet.cell(row=row, column=col+col_adjust, value=headers)
-        data.alignment = Alignment(horizontal="center", vertical="center")
-        data.fill = PatternFill(start_color=header_color,
-                                end_color=header_color, fill_type="solid")
+        data.style = HEADER_STYLE
         col_adjust += 1
 
     return workbook, worksheet
 
+"""
+Create a write-only workbook that streams rows to disk as they are added,
+so memory use stays flat however many sets are written. Unlike
+create_wookbook_and_sheet this always starts a new file, so process_sets
+won't stream to an output file that already exists.
+"""
+def create_streaming_workbook_and_sheet():
+    workbook = Workbook(write_only=True)
+    register_styles(workbook)
 
-def create_api_session(config_file):
+    now = datetime.now() # current date and time
+    date_stamp = now.strftime("%m_%d_%Y")
+    worksheet = workbook.create_sheet('Items_'+date_stamp)
+
+    worksheet.column_dimensions['B'].width = 20
+    worksheet.column_dimensions['C'].width = 30
+    worksheet.column_dimensions['D'].width = 20
+    worksheet.column_dimensions['E'].width = 20
+    worksheet.column_dimensions['F'].width = 20
+    worksheet.column_dimensions['G'].width = 20
 
-    config = configparser.ConfigParser()
-    config.read(config_file)
+    for column in 'IJKLMNO':
+        worksheet.column_dimensions[column].width = 15
 
-    # fill in with your data from https://www.bricklink.com/v2/api/register_consumer.page
-    consumer_key = config['secrets']['consumer_key']
-    consumer_secret = config['secrets']['consumer_secret']
-    token_value = config['secrets']['token_value']
-    token_secret = config['secrets']['token_secret']
+    xls_headers = ['Item', 'Name', 'Category', 'Avg Price', 'Min Price', 'Max Price', 'Quantity', 'Year'] + STAT_HEADERS
+    worksheet.append(styled_row(worksheet, xls_headers, HEADER_STYLE))
 
+    return workbook, worksheet
+
+
+"""
+Return the shared API session for config_file. The session, and its pool
+of open connections, is reused for as long as the credentials don't change.
+"""
+def create_api_session(config_file):
     try:
-        session = Bricklink(
-            consumer_key=consumer_key,
-            consumer_secret=consumer_secret,
-            token=token_value,
-            token_secret=token_secret
-        )
+        return session_provider.get_session(config_file)
     except Exception as e:
-        logging.error('Could not get auth token - ', str(e))
-        return null
+        logging.error('Could not get auth token - ' + str(e))
+        return None
 
-    return session
 
-
-def generate_single_sheet(session, file_handler, workbook, worksheet):
+def generate_single_sheet(session, file_handler, workbook, worksheet, max_workers=DEFAULT_WORKERS, journal=None,
+                          fetch=fetch_details):
     logging.info('Writing all sets to the same file')
+    history = price_history.get_history()
     total = 0
     _row = 1
     _col = 1
-    while True:
-        line = file_handler.readline()
-        if not line:
-            break
-        #print(line.strip())
-        number = line.strip()
-        res = getDetails(session, number)
+    set_numbers = read_set_list(file_handler)
+    details = profiler.iterate('fetch wait', fetch(session, set_numbers, max_workers, journal))
+    for number, res in add_stats(details, stats_batch_size(max_workers)):
         if not res:
-            sys.exit(1)
+            raise FetchFailed('Could not get details for set: ' + number)
         for key in res:
-            print_details(res[key], key)
-            logging.debug(json.dumps(res, indent=4, sort_keys=True))
+            with profiler.stage('print details'):
+                print_details(res[key], key)
+            logging.debug(LazyJSON(res))
+            record_history(history, key, res[key])
             total += res[key]['current']['avg']
 
             _row += 1
 
-            data = worksheet.cell(row=_row, column=_col, value=key)
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col+1, value=res[key]['name'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col+2, value=res[key]['category'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col+3, value=res[key]['current']['avg'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col+4, value=res[key]['current']['min'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col+5, value=res[key]['current']['max'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col+6, value=res[key]['current']['quantity'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col+7, value=res[key]['year'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
+            values = [key, res[key]['name'], res[key]['category'], res[key]['current']['avg'],
+                      res[key]['current']['min'], res[key]['current']['max'],
+                      res[key]['current']['quantity'], res[key]['year']] + stat_values(res[key])
+
+            with profiler.stage('sheet write'):
+                if workbook.write_only:
+                    worksheet.append(styled_row(worksheet, values, CENTER_STYLE))
+                else:
+                    for col_adjust, value in enumerate(values):
+                        data = worksheet.cell(row=_row, column=_col+col_adjust, value=value)
+                        data.style = CENTER_STYLE
 
     logging.info("Total: " + str(total) + "USD")
 
-def generate_multi_sheet(session, file_handler, workbook):
+def generate_multi_sheet(session, file_handler, workbook, max_workers=DEFAULT_WORKERS, journal=None,
+                         fetch=fetch_details):
 
     logging.info("Writing sets per sheet`")
 
+    history = price_history.get_history()
     total = 0
     _row = 6
     _col = 2
@@ -314,43 +658,37 @@ def generate_multi_sheet(session, file_handler, workbook):
     now = datetime.now()
     date_stamp = now.strftime("%m-%d-%Y")
 
-    while True:
-        line = file_handler.readline()
-        if not line:
-            break
-        number = line.strip()
-        res = getDetails(session, number)
+    set_numbers = read_set_list(file_handler)
+    details = profiler.iterate('fetch wait', fetch(session, set_numbers, max_workers, journal))
+    for number, res in add_stats(details, stats_batch_size(max_workers)):
         if not res:
             logging.error('Could not get details for set:' +number)
         for key in res:
             worksheet = add_worksheet(workbook, key)
             # Find next available row on column B
-            for index in range(6, 1000):
-                if worksheet.cell(row=index, column=2).value is None:
-                    _row = index
-                    logging.debug('Inserting at ros ' + str(_row))
-                    break
-                else:
-                    logging.debug('Row contents: '+
-                                  worksheet.cell(row=index, column=2).value)
-
-            print_details(res[key], key)
-            logging.debug(json.dumps(res, indent=4, sort_keys=True))
-            total += res[key]['avg']
-
-            data = worksheet.cell(row=2, column=3, value=res[key]['name'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=3, column=3, value=res[key]['category'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col, value=date_stamp)
-            data = worksheet.cell(row=_row, column=_col+1, value=res[key]['current']['avg'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col+2, value=res[key]['current']['min'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col+3, value=res[key]['current']['max'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
-            data = worksheet.cell(row=_row, column=_col+4, value=res[key]['current']['quantity'])
-            data.alignment = Alignment(horizontal="center", vertical="center")
+            _row = next_free_row(worksheet, 6)
+            logging.debug('Inserting at row ' + str(_row))
+
+            with profiler.stage('print details'):
+                print_details(res[key], key)
+            logging.debug(LazyJSON(res))
+            record_history(history, key, res[key])
+            total += res[key]['current']['avg']
+
+            with profiler.stage('sheet write'):
+                data = worksheet.cell(row=2, column=3, value=res[key]['name'])
+                data.style = CENTER_STYLE
+                data = worksheet.cell(row=3, column=3, value=res[key]['category'])
+                data.style = CENTER_STYLE
+                data = worksheet.cell(row=_row, column=_col, value=date_stamp)
+                data = worksheet.cell(row=_row, column=_col+1, value=res[key]['current']['avg'])
+                data.style = CENTER_STYLE
+                data = worksheet.cell(row=_row, column=_col+2, value=res[key]['current']['min'])
+                data.style = CENTER_STYLE
+                data = worksheet.cell(row=_row, column=_col+3, value=res[key]['current']['max'])
+                data.style = CENTER_STYLE
+                data = worksheet.cell(row=_row, column=_col+4, value=res[key]['current']['quantity'])
+                data.style = CENTER_STYLE
 
     logging.info("Total: " + str(total) + "USD")
 
@@ -362,33 +700,24 @@ def generate_multi_sheet(session, file_handler, workbook):
         summary.column_dimensions['B'].width = 10
         summary.column_dimensions['C'].width = 20
 
-        header_color = "00C0C0C0"
         data = summary.cell(row=2, column=2, value="Date")
-        data.fill = PatternFill(start_color=header_color,
-                                end_color=header_color, fill_type="solid")
-        data.alignment = Alignment(horizontal="center", vertical="center")
+        data.style = HEADER_STYLE
 
         data = summary.cell(row=2, column=3, value="Total")
-        data.fill = PatternFill(start_color=header_color,
-                                end_color=header_color, fill_type="solid")
-        data.alignment = Alignment(horizontal="center", vertical="center")
-
-    for index in range(3, 1000):
-        if summary.cell(row=index, column=2).value is None:
-            _srow = index
-            logging.debug('Inserting at ros ' + str(_srow))
-            break
-        else:
-            logging.debug('Row contents: '+summary.cell(row=index, column=2).value)
+        data.style = HEADER_STYLE
+
+    _srow = next_free_row(summary, 3)
+    logging.debug('Inserting at row ' + str(_srow))
 
     data = summary.cell(row=_srow, column=2, value=date_stamp)
-    data.alignment = Alignment(horizontal="center", vertical="center")
+    data.style = CENTER_STYLE
     data = summary.cell(row=_srow, column=3, value=total)
-    data.alignment = Alignment(horizontal="center", vertical="center")
+    data.style = CENTER_STYLE
 
 def test_config(config_file = 'config.ini'):
     session = create_api_session(config_file)
-    res = getDetails(session, "75105-1")
+    # A settings check, not prices worth keeping
+    res = getDetails(session, "75105-1", archive=False)
 
     if res:
         return True
@@ -398,7 +727,9 @@ def test_config(config_file = 'config.ini'):
 """
 The main handler routine.
 """
-def sheet_handler(set_num, set_list, multi_sheet, output_file = 'Sets.xlsx', config_file = 'config.ini'):
+def sheet_handler(set_num, set_list, multi_sheet, output_file = 'Sets.xlsx', config_file = 'config.ini',
+                  max_workers = DEFAULT_WORKERS, resume = False, stream = False, use_async = False,
+                  incremental = False):
     
     logging.info('Setup API session')
     session = create_api_session(config_file)
@@ -407,6 +738,27 @@ def sheet_handler(set_num, set_list, multi_sheet, output_file = 'Sets.xlsx', con
         logging.error('Could not create an API session')
         sys.exit(1)
 
+    # Count this run's calls apart from other jobs running in the web app
+    with limiter.run():
+        # Only fetches the category list on the first run in this process
+        category_index.preload(lambda: limiter.call(session.category.get_category_list))
+
+        # Fresh sets are written from the price history instead of being fetched
+        refresh = IncrementalRefresh() if incremental else None
+
+        try:
+            process_sets(session, set_num, set_list, multi_sheet, output_file, max_workers, resume, stream,
+                         use_async, refresh)
+        finally:
+            limiter.log_summary()
+            if refresh:
+                refresh.log_summary()
+
+"""
+Process a single set or a set list.
+"""
+def process_sets(session, set_num, set_list, multi_sheet, output_file, max_workers, resume, stream, use_async=False,
+                 refresh=None):
     if set_num:
         logging.info('Processing single set')
         try:
@@ -415,18 +767,35 @@ def sheet_handler(set_num, set_list, multi_sheet, output_file = 'Sets.xlsx', con
             logging.exception("Could not get set details" + str(e))
             return None
 
-        logging.debug(json.dumps(res, indent=4, sort_keys=True))
+        # Adds the statistics to res in place
+        list(add_stats([(set_num, res)]))
+        logging.debug(LazyJSON(res))
+        history = price_history.get_history()
         for key in res:
-            print_details(res[key], key)
+            with profiler.stage('print details'):
+                print_details(res[key], key)
+            record_history(history, key, res[key])
     elif set_list:
         xls_filename = output_file
 
         if multi_sheet:
+            if stream:
+                logging.warning('Streaming output is not available with multiple sheets, ignoring it')
             workbook = create_wookbook(xls_filename)
+        elif stream:
+            if exists(xls_filename):
+                logging.error(xls_filename + ' already exists and streaming would replace it, '
+                              'choose a new output file with -o')
+                return None
+            (workbook, worksheet) = create_streaming_workbook_and_sheet()
         else:
             (workbook, worksheet) = create_wookbook_and_sheet(xls_filename)
 
         logging.info('Processing multiple sets')
+        fetch = fetch_details_with_async_client if use_async else fetch_details
+        if refresh:
+            fetch = functools.partial(fetch, refresh=refresh)
+        journal = None
         if exists(set_list):
             logging.info("Processing sets in " + set_list)
 
@@ -438,13 +807,26 @@ def sheet_handler(set_num, set_list, multi_sheet, output_file = 'Sets.xlsx', con
                 now = datetime.now()
                 date_stamp = now.strftime("%m-%d-%Y")
 
-                # Sheet per item and Summary
-                if multi_sheet:
-                    generate_multi_sheet(session, file_handler, workbook)
-                else:
-                    generate_single_sheet(session, file_handler, workbook, worksheet)
-
-            workbook.save(filename=xls_filename)
+                # Fetched sets are journaled so a failed run can be resumed
+                journal = Journal(journal_path(xls_filename)).open(resume)
+                try:
+                    # Sheet per item and Summary
+                    if multi_sheet:
+                        generate_multi_sheet(session, file_handler, workbook, max_workers, journal, fetch)
+                    else:
+                        generate_single_sheet(session, file_handler, workbook, worksheet, max_workers, journal,
+                                              fetch)
+                except FetchFailed as e:
+                    # The workbook isn't saved, and the journal is kept for -r
+                    logging.error(str(e) + ', stopping. Run again with -r to keep the sets fetched so far')
+                    raise
+                finally:
+                    journal.close()
+
+            with profiler.stage('save'):
+                workbook.save(filename=xls_filename)
+            if journal:
+                journal.remove()
 
 if __name__ == '__main__':
     sheet_handler("71016-1", "", False, False)
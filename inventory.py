@@ -1,6 +1,9 @@
-from generate_sheets import sheet_handler
+from generate_sheets import sheet_handler, DEFAULT_WORKERS
 import argparse
 import logging
+import session_provider
+import replay
+from profiling import profiler
 
 logging.basicConfig(
 format='%(asctime)s %(levelname)-8s %(message)s',
@@ -15,18 +18,68 @@ def main():
 	parser.add_argument('-s', '--set', type=str)
 	parser.add_argument('-f', '--file', type=str)
 	parser.add_argument('-m', '--multi', type=str)
-	parser.add_argument('-o', '--output', type=str)
+	parser.add_argument('-v', '--verbose', action="store_true")
+	parser.add_argument('-o', '--output', type=str, default='Sets.xlsx')
+	parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+	                    help='number of sets fetched at the same time')
+	parser.add_argument('-r', '--resume', action="store_true",
+	                    help='skip sets already fetched by a failed run')
+	parser.add_argument('--stream', action="store_true",
+	                    help='stream rows to a new workbook to keep memory flat')
+	parser.add_argument('--async-fetch', action="store_true",
+	                    help='fetch sets with the asyncio client on a single thread')
+	parser.add_argument('-i', '--incremental', action="store_true",
+	                    help='reuse the last price history snapshot of sets that are still fresh')
+	archive_args = parser.add_mutually_exclusive_group()
+	archive_args.add_argument('--record', nargs='?', const=replay.DEFAULT_ARCHIVE, metavar='ARCHIVE',
+	                          help='save every Bricklink response to a compressed archive')
+	archive_args.add_argument('--replay', nargs='?', const=replay.DEFAULT_ARCHIVE, metavar='ARCHIVE',
+	                          help='answer Bricklink calls from a recorded archive, without the network')
+	parser.add_argument('--profile', action="store_true",
+	                    help='log the time spent in each stage and Bricklink endpoint at the end of the run')
+	parser.add_argument('--cprofile', type=str, metavar='FILE',
+	                    help='with --profile, also write cProfile stats of the main thread to FILE')
 	args = parser.parse_args()
 
+	# generate_sheets configures logging for DEBUG when it is imported, which
+	# would make every run dump the full API payloads
+	if args.verbose:
+		logging.getLogger().setLevel(logging.DEBUG)
+	else:
+		logging.getLogger().setLevel(logging.INFO)
+
 	set_num = args.set
 	set_list = args.file
 	output_file = args.output
 	multi_sheet = args.multi
+	max_workers = args.workers
+	use_async = args.async_fetch
+
+	if args.profile or args.cprofile:
+		profiler.enable(args.cprofile)
+
+	# sheet_handler gets the same shared session, with the archive mounted
+	archive = None
+	if args.record or args.replay:
+		if use_async:
+			logging.warning('The asyncio client can\'t be recorded or replayed, fetching with threads')
+			use_async = False
+		try:
+			archive = replay.install(session_provider.get_session('config.ini'), args.record, args.replay)
+		except Exception as e:
+			logging.error('Could not set up the response archive: ' + str(e))
+			return
 
 	try:
-		sheet_handler(set_num, set_list, multi_sheet, output_file)
+		sheet_handler(set_num, set_list, multi_sheet, output_file, max_workers=max_workers,
+		              resume=args.resume, stream=args.stream, use_async=use_async,
+		              incremental=args.incremental)
 	except Exception as e:
 		logging.exception("Failed to call sheet_handler" + str(e))
+	finally:
+		if archive:
+			archive.close()
+		profiler.finish()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,391 @@
+"""
+Batch sync engine for the Inventory sheet of inventory_update.
+
+inventory_update used to walk the sheet one row at a time, making every
+price guide, inventory lookup and create or update call for a row before
+moving on to the next. The engine splits a run into stages instead:
+
+  1. read the sheet into a list of row intents,
+  2. look up each distinct part, color and condition once, in parallel,
+  3. fetch the Bricklink state of the rows being updated, in parallel,
+     or from one snapshot of the whole store inventory,
+  4. plan every row with the same rules as before,
+  5. apply the creates and updates with bounded concurrency,
+  6. write the results back to the sheet in a single pass.
+
+Rows that were planned before a failure, including running out of the daily
+budget, are still written back, so no new inventory id is lost.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from log_utils import LazyJSON
+from profiling import profiler
+from rate_limit import limiter, QuotaExceeded
+from store_snapshot import StoreSnapshot, log_listing
+
+# Parts looked up and inventories fetched at the same time
+DEFAULT_WORKERS = 8
+
+# Creates and updates sent at the same time
+DEFAULT_WRITERS = 4
+
+# Inventory sheet columns
+INVENTORY_ID_COLUMN = 2
+TYPE_COLUMN = 3
+ITEM_COLUMN = 4
+COLOR_COLUMN = 6
+PRICE_COLUMN = 7
+QUANTITY_COLUMN = 8
+CONDITION_COLUMN = 9
+DESCRIPTION_COLUMN = 12
+REMARK_COLUMN = 14
+STOCKROOM_COLUMN = 15
+STOCKROOM_ID_COLUMN = 16
+RETAIN_COLUMN = 17
+NAME_COLUMN = 24
+
+FIRST_ROW = 4
+
+
+class RowIntent:
+    """One row of the Inventory sheet and what the sync does with it."""
+
+    def __init__(self, row, inventory_id, values):
+        self.row = row
+        self.inventory_id = inventory_id
+        self.item_type = values[TYPE_COLUMN]
+        self.item_num = values[ITEM_COLUMN]
+        self.color = values[COLOR_COLUMN]
+        self.price = values[PRICE_COLUMN]
+        self.quantity = values[QUANTITY_COLUMN]
+        self.condition = values[CONDITION_COLUMN]
+        self.description = values[DESCRIPTION_COLUMN]
+        self.remark = values[REMARK_COLUMN]
+        self.stockroom = values[STOCKROOM_COLUMN]
+        self.stockroom_id = values[STOCKROOM_ID_COLUMN]
+        self.retain = values[RETAIN_COLUMN]
+        self.set_color(self.color)
+
+        # Filled in while planning
+        self.inventory_item = None
+        self.action = None
+        # column -> value to write back to the sheet
+        self.cells = {}
+
+    def set_color(self, color_id):
+        self.color = color_id
+        # Rows with the same part_key share a price guide
+        self.part_key = (self.item_num, self.color, self.condition)
+
+    def log(self):
+        logging.info('')
+        logging.info('Processing: ' + str(self.item_type))
+        if self.inventory_id:
+            logging.info("  Inventory Id: " + str(self.inventory_id))
+        logging.info("  Item Num: " + str(self.item_num))
+        logging.info("  Color: " + str(self.color))
+        logging.info("  Price: " + str(self.price))
+        logging.info("  Quantity: " + str(self.quantity))
+        logging.debug("  Condition: " + str(self.condition))
+        logging.debug("  Description: " + str(self.description))
+        logging.debug("  Stockroom: " + str(self.stockroom))
+        logging.debug("  Remark: " + str(self.remark))
+        logging.debug("  Stockroom Id: " + str(self.stockroom_id))
+        logging.debug("  Retain: " + str(self.retain))
+
+
+class InventorySync:
+
+    def __init__(self, worksheet, session, colors, get_part_details, dryrun=False, skip=False,
+                 workers=DEFAULT_WORKERS, writers=DEFAULT_WRITERS, bulk_snapshot=False):
+        """
+        colors is the ColorRegistry used to read the color column, which
+        may hold a color id or name. get_part_details(number, session,
+        color_id, condition) returns
+        {number: details} for a part, or a false value if its price guide
+        can't be fetched. With
+        bulk_snapshot the store inventory is downloaded in one call instead
+        of fetching the listing of each row being updated.
+        """
+        self.worksheet = worksheet
+        self.session = session
+        self.colors = colors
+        self.get_part_details = get_part_details
+        self.dryrun = dryrun
+        self.skip = skip
+        self.workers = workers
+        self.writers = writers
+        self.bulk_snapshot = bulk_snapshot
+        self.intents = []
+        # Every inventory id in the sheet, including the rows that are skipped
+        self.sheet_ids = []
+        self.snapshot = None
+
+    def run(self):
+        planned = []
+        try:
+            with profiler.stage('read sheet'):
+                self.intents = self.read_intents()
+            logging.info('Read ' + str(len(self.intents)) + ' rows to sync')
+
+            with profiler.stage('lookup parts'):
+                parts = self.lookup_parts(self.intents)
+            updating = [intent for intent in self.intents
+                        if intent.inventory_id and not failed(parts[intent.part_key])]
+            with profiler.stage('fetch remote'):
+                if self.bulk_snapshot:
+                    self.snapshot = StoreSnapshot.fetch(self.session)
+                    remote = self.remote_from_snapshot(updating)
+                else:
+                    remote = self.fetch_remote(updating)
+
+            with profiler.stage('plan'):
+                for intent in self.intents:
+                    intent.log()
+                    if self.plan(intent, parts[intent.part_key], remote.get(intent.inventory_id)):
+                        planned.append(intent)
+                if self.snapshot is not None:
+                    self.report_missing()
+
+            if not self.dryrun:
+                with profiler.stage('apply'):
+                    self.apply(planned)
+        finally:
+            with profiler.stage('write back'):
+                self.write_back(planned)
+
+    def read_intents(self):
+        """Read every row that needs syncing, skipping the incomplete ones."""
+        intents = []
+        row = FIRST_ROW
+        for values in self.worksheet.iter_rows(min_row=FIRST_ROW, max_col=NAME_COLUMN, values_only=True):
+            values = (None,) + values
+            if values[TYPE_COLUMN] is None:
+                break
+            current = row
+            row += 1
+            logging.debug('Column Index: ' + str(current))
+
+            inventory_id = values[INVENTORY_ID_COLUMN] or 0
+            if inventory_id:
+                logging.debug("Entry has Inventory Id: " + str(inventory_id))
+                self.sheet_ids.append(inventory_id)
+                if self.skip:
+                    continue
+
+            intent = RowIntent(current, inventory_id, values)
+            if intent.item_num is None:
+                logging.info('Empty row ' + str(current) + '!!')
+                continue
+            if intent.quantity == 0 or intent.quantity is None:
+                logging.warning('Row ' + str(current) + ': no quantity provided or it\'s zero')
+                continue
+            if intent.color == 0 or intent.color is None:
+                logging.warning('Row ' + str(current) + ': no color provided or it\'s zero')
+                continue
+            color_id = self.colors.resolve(intent.color)
+            if color_id is None:
+                logging.warning('Row ' + str(current) + ': unknown color ' + str(intent.color))
+                continue
+            intent.set_color(color_id)
+
+            intent.inventory_item = {
+                'item': {'type': intent.item_type, 'no': intent.item_num},
+                'color_id': intent.color,
+                'unit_price': intent.price,
+                'new_or_used': intent.condition,
+                'description': intent.description,
+                'is_stock_room': intent.stockroom,
+                'stock_room_id': intent.stockroom_id,
+                'is_retain': intent.retain,
+                'remarks': self.colors.name(intent.color),
+            }
+            intents.append(intent)
+        return intents
+
+    def lookup_parts(self, intents):
+        """Price guide and name of each distinct part_key."""
+        keys = list(dict.fromkeys(intent.part_key for intent in intents))
+        logging.info('Looking up ' + str(len(keys)) + ' distinct parts, colors and conditions')
+        return dict(zip(keys, self.parallel(self.lookup_part, keys, self.workers)))
+
+    def lookup_part(self, part_key):
+        number, color_id, condition = part_key
+        try:
+            return self.get_part_details(number, self.session, color_id, condition) or LookupFailed('no price guide')
+        except QuotaExceeded:
+            raise
+        except Exception as e:
+            return LookupFailed(str(e))
+
+    def fetch_remote(self, intents):
+        """Current Bricklink inventory of each row being updated, keyed by inventory id."""
+        ids = list(dict.fromkeys(intent.inventory_id for intent in intents))
+        logging.info('Fetching ' + str(len(ids)) + ' store inventories')
+        return dict(zip(ids, self.parallel(self.fetch_inventory, ids, self.workers)))
+
+    def fetch_inventory(self, inventory_id):
+        try:
+            return limiter.call(self.session.store_inventory.get_store_inventory, inventory_id)
+        except QuotaExceeded:
+            raise
+        except Exception as e:
+            return LookupFailed(str(e))
+
+    def remote_from_snapshot(self, intents):
+        """Listing of each row being updated, from the store snapshot."""
+        remote = {}
+        for intent in intents:
+            listing = self.snapshot.get(intent.inventory_id)
+            remote[intent.inventory_id] = listing if listing is not None else LookupFailed(
+                'Inventory Id ' + str(intent.inventory_id) + ' is not in the store inventory')
+        return remote
+
+    def report_missing(self):
+        """Log the listings in the store that no row of the sheet refers to."""
+        missing = self.snapshot.missing(self.sheet_ids)
+        if not missing:
+            logging.info('Every listing in the store inventory is in the sheet')
+            return
+        logging.warning(str(len(missing)) + ' listings in the store inventory are not in the sheet:')
+        for listing in missing:
+            log_listing(listing)
+
+    def plan(self, intent, part, remote):
+        """
+        Work out the API call and sheet changes for a row. Returns True if
+        the row goes on to be applied (or reported in a dry run).
+        """
+        if failed(part):
+            logging.warning('  Could not get pricing details for ' + str(intent.item_num))
+            logging.warning('  ' + str(part))
+            return False
+        details = part[intent.item_num]
+        inventory_item = intent.inventory_item
+        logging.debug(LazyJSON(inventory_item))
+
+        if not intent.inventory_id:
+            logging.info('Creating Inventory Item')
+            if self.snapshot is not None:
+                for listing in self.snapshot.find(intent.item_num, intent.color, intent.condition):
+                    logging.warning('  Store already has Inventory Id ' + str(listing['inventory_id']) +
+                                    ' for this part, color and condition')
+            if intent.price is None:
+                inventory_item['unit_price'] = details['avg']
+                if not self.dryrun:
+                    intent.cells[PRICE_COLUMN] = details['avg']
+                else:
+                    logging.info('  Avg Unit Price: ' + str(inventory_item['unit_price']))
+            if not self.dryrun:
+                intent.cells[NAME_COLUMN] = details['name']
+            else:
+                logging.info('  ## Dry Run mode: no changes applied to Bricklink inventory ##')
+            inventory_item['quantity'] = intent.quantity
+            intent.action = 'create'
+            return True
+
+        logging.info('Updating Inventory Item')
+        if not self.dryrun:
+            intent.cells[NAME_COLUMN] = details['name']
+            intent.cells[PRICE_COLUMN] = details['avg']
+        else:
+            logging.info('  Latest average price is ' + str(details['avg']))
+            if inventory_item['unit_price'] is None:
+                logging.info('  No price in the spreadsheet')
+            elif details['avg'] > inventory_item['unit_price']:
+                logging.info('  Price has increased')
+            elif details['avg'] < inventory_item['unit_price']:
+                logging.info('  Price has decreased')
+            else:
+                logging.info('  Price has not changed')
+
+        if failed(remote):
+            logging.warning('  Could not get the Bricklink inventory for ' + str(intent.item_num))
+            logging.warning('  ' + str(remote))
+            return True
+        curr_quantity = remote['quantity']
+
+        # Update new quantity
+        if curr_quantity > intent.quantity:
+            delta = curr_quantity - intent.quantity
+            logging.info('  Increase quantity in spreadsheet by ' + str(delta))
+            inventory_item['quantity'] = delta
+            if not self.dryrun:
+                intent.cells[QUANTITY_COLUMN] = intent.quantity + delta
+        if curr_quantity < intent.quantity:
+            delta = intent.quantity - curr_quantity
+            logging.info('  Increase quantity in Bricklink by ' + str(delta))
+            inventory_item['quantity'] = delta
+        else:
+            logging.info('  No change in quantity')
+
+        if self.dryrun:
+            logging.info('  Bricklink quantity: ' + str(curr_quantity))
+            logging.info('  Spreadsheet quantity: ' + str(intent.quantity))
+            logging.info('  ## Dry Run mode: no changes applied to Bricklink inventory ##')
+
+        logging.debug(LazyJSON(inventory_item))
+        intent.action = 'update'
+        return True
+
+    def apply(self, intents):
+        """Send the creates and updates, at most self.writers at a time."""
+        intents = [intent for intent in intents if intent.action]
+        logging.info('Applying ' + str(len(intents)) + ' changes')
+        self.parallel(self.apply_one, intents, self.writers)
+
+    def apply_one(self, intent):
+        # The new inventory id is kept on the intent straight away, so it is
+        # written back even if a later call stops the run
+        try:
+            if intent.action == 'create':
+                response = limiter.write(self.session.store_inventory.create_store_inventory, intent.inventory_item)
+                intent.cells[INVENTORY_ID_COLUMN] = response['inventory_id']
+                logging.info('  Row ' + str(intent.row) + ': created Inventory Id ' +
+                             str(response['inventory_id']) + ', unit price ' + str(response['unit_price']))
+            else:
+                response = limiter.write(self.session.store_inventory.update_store_inventory, intent.inventory_id,
+                                         intent.inventory_item)
+            logging.debug(response)
+        except QuotaExceeded:
+            raise
+        except Exception as error:
+            logging.warning('  Could not ' + intent.action + ' inventory for ' + str(intent.item_num) +
+                            ' (row ' + str(intent.row) + ')')
+            logging.warning('  ' + str(error))
+
+    def write_back(self, intents):
+        """Write every planned cell change to the sheet in one pass."""
+        changed = 0
+        for intent in intents:
+            for column, value in intent.cells.items():
+                self.worksheet.cell(row=intent.row, column=column).value = value
+                changed += 1
+        if changed:
+            logging.info('Updated ' + str(changed) + ' cells in the Inventory sheet')
+
+    def parallel(self, fn, items, workers):
+        """
+        fn over items on up to workers threads, results in order. Stops
+        at the first QuotaExceeded, dropping work that hasn't started.
+        """
+        executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='inventory-sync')
+        try:
+            return list(executor.map(fn, items))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+class LookupFailed:
+    """Stands in for the result of a call that failed, keeping the reason."""
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return self.reason
+
+
+def failed(result):
+    return isinstance(result, LookupFailed)
@@ -1,25 +1,34 @@
 """
 This is neat little utility that updates inventory on Bricklink.
 """
-import json
 import argparse
 import sys
 import logging
 import os
 from os import stat
 from os.path import exists
-from bricklink_api.auth import oauth
-from bricklink_api.catalog_item import get_price_guide, get_item, get_item_image, Type, NewOrUsed
-from bricklink_api.category import get_category
-from bricklink_api.user_inventory import get_inventory, create_inventory, update_inventory
-from bricklink_api.color import get_color_list
 import html
 from html.parser import HTMLParser
 from openpyxl import load_workbook, Workbook
 from openpyxl.styles import Alignment,Font,PatternFill
-import configparser
 from datetime import datetime
-
+import metadata_cache
+import price_cache
+from rate_limit import limiter, QuotaExceeded
+from metadata_cache import item_key
+from price_cache import price_key
+from categories import category_index
+from colors import color_registry, COLORS_FILE
+import session_provider
+import replay
+from log_utils import LazyJSON
+from profiling import profiler
+from inventory_sync import InventorySync, DEFAULT_WORKERS, DEFAULT_WRITERS
+
+
+# Price guides are for sales to this country and region
+COUNTRY_CODE = "US"
+REGION = "north_america"
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
@@ -30,45 +39,53 @@ logging.basicConfig(
 Grab Color from loopup table
 """
 def getColorName(colorId):
-    pass
+    return color_registry.name(colorId)
 
 """
-This calls the API functions to get the data.
+This calls the API functions to get the data. The price guide is for the
+part in color_id and condition, and comes from the price cache when it has
+been fetched recently.
 """
-def getPartDetails(number, auth_params):
-    logging.debug("Getting details for " + str(number))
+def getPartDetails(number, session, color_id=None, condition=None):
+    logging.debug("Getting details for " + str(number) + ", color " + str(color_id) + ", condition " + str(condition))
     h_parse = html.parser
+    condition = condition or "U"
 
-    json_obj = get_price_guide(Type.PART, number, new_or_used=NewOrUsed.USED, \
-                               country_code="US", region="north_america", auth=auth_params)
+    try:
+        data = price_cache.get_cache().get_or_fetch(
+            price_key("PART", number, color_id, condition, REGION),
+            lambda: price_cache.summary(limiter.call(session.catalog_item.get_price_guide, "PART", number,
+                                                     color_id=color_id, new_or_used=condition,
+                                                     country_code=COUNTRY_CODE, region=REGION)))
+    except QuotaExceeded:
+        raise
+    except Exception as e:
+        logging.warning("API Error!! " + str(e))
+        return 0
 
-    logging.debug(json.dumps(json_obj, indent=4, sort_keys=True))
-    meta = json_obj['meta']
+    logging.debug(LazyJSON(data))
 
-    if meta['code'] == 200:
-        data = json_obj['data']
+    cache = metadata_cache.get_cache()
+    type_data = cache.get_or_fetch(item_key('PART', number),
+                                   lambda: limiter.call(session.catalog_item.get_item, "PART", number))
+    logging.debug(LazyJSON(type_data))
 
-        type_data = get_item(Type.PART, number, auth=auth_params)
-        logging.debug(json.dumps(type_data, indent=4, sort_keys=True))
+    category_id = type_data['category_id']
+    category_data = category_index.get(category_id,
+                                       lambda: limiter.call(session.category.get_category, category_id))
+    logging.debug(LazyJSON(category_data))
 
-        category_data = get_category(type_data['data']['category_id'], auth=auth_params)
-        logging.debug(json.dumps(category_data, indent=4, sort_keys=True))
+    elem_data = {}
+    elem_data[number] = {}
+    elem_data[number]['name'] = h_parse.unescape(type_data['name'])
+    elem_data[number]['category'] = h_parse.unescape(category_data['category_name'])
+    elem_data[number]['avg'] = float(data['avg_price'])
+    elem_data[number]['max'] = float(data['max_price'])
+    elem_data[number]['min'] = float(data['min_price'])
+    elem_data[number]['quantity'] = data['unit_quantity']
+    elem_data[number]['currency'] = data['currency_code']
 
-        elem_data = {}
-        elem_data[number] = {}
-        elem_data[number]['name'] = h_parse.unescape(type_data['data']['name'])
-        elem_data[number]['category'] = h_parse.unescape(category_data['data']['category_name'])
-        elem_data[number]['avg'] = float(data['avg_price'])
-        elem_data[number]['max'] = float(data['max_price'])
-        elem_data[number]['min'] = float(data['min_price'])
-        elem_data[number]['quantity'] = data['unit_quantity']
-        elem_data[number]['currency'] = data['currency_code']
-
-        return elem_data
-    else:
-        logging.warning("API Error!! " + str(meta['code']))
-        logging.warning("API Message!! " + str(meta['message']))
-        return 0
+    return elem_data
 
 """
 Open inventory workbook
@@ -90,205 +107,87 @@ def main():
     parser.add_argument('-v', '--verbose', action="store_true")
     parser.add_argument('-s', '--skip', action="store_true")
     parser.add_argument('-d', '--dryrun', action="store_true")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='number of parts and inventories looked up at the same time')
+    parser.add_argument('--writers', type=int, default=DEFAULT_WRITERS,
+                        help='number of creates and updates sent at the same time')
+    parser.add_argument('-b', '--bulk-snapshot', action="store_true",
+                        help='download the whole store inventory in one call instead of one call per row')
+    parser.add_argument('--refresh-colors', action="store_true",
+                        help='rebuild ' + COLORS_FILE + ' from the Bricklink color list')
+    archive_args = parser.add_mutually_exclusive_group()
+    archive_args.add_argument('--record', nargs='?', const=replay.DEFAULT_ARCHIVE, metavar='ARCHIVE',
+                              help='save every Bricklink response to a compressed archive')
+    archive_args.add_argument('--replay', nargs='?', const=replay.DEFAULT_ARCHIVE, metavar='ARCHIVE',
+                              help='answer Bricklink calls from a recorded archive, without the network')
+    parser.add_argument('--profile', action="store_true",
+                        help='log the time spent in each stage and Bricklink endpoint at the end of the run')
+    parser.add_argument('--cprofile', type=str, metavar='FILE',
+                        help='with --profile, also write cProfile stats of the main thread to FILE')
     args = parser.parse_args()
 
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    logging.info('Read configuration')
-    config = configparser.ConfigParser()
-    config.read('config.ini')
+    if args.profile or args.cprofile:
+        profiler.enable(args.cprofile)
 
+    logging.info('Read configuration')
     # Read color conversion data
+    if not args.refresh_colors:
+        try:
+            color_registry.load_file(COLORS_FILE)
+        except (IOError, ValueError) as e:
+            logging.critical("Could not open: " + COLORS_FILE + " (" + str(e) + ")")
+            sys.exit(2)
+
+    # Same shared session, and connection pool, as generate_sheets
     try:
-        with open('colors.json') as configData:
-            configData = json.load(configData)
-            # Process dict
-            logging.debug(json.dumps(configData, indent=4, sort_keys=True))
-    except IOError as e:
-        logging.critical("Could not open: " + args.config)
-        sys.exit(2)
-    
-    # fill in with your data from https://www.bricklink.com/v2/api/register_consumer.page
-    consumer_key = config['secrets']['consumer_key']
-    consumer_secret = config['secrets']['consumer_secret']
-    token_value = config['secrets']['token_value']
-    token_secret = config['secrets']['token_secret']
-
-    try:
-        auth = oauth(consumer_key, consumer_secret, token_value, token_secret)
+        session = session_provider.get_session('config.ini')
     except Exception as error:
         logging.error('Could not get auth token' + str(error))
         sys.exit(1)
 
-    workbook = setup_xls_writer('LegoParts.xlsx')
-
-    worksheet = workbook['Inventory']
-    index = 4
-    while worksheet.cell(row=index, column=3).value is not None:
-        logging.debug('Column Index: ' + str(index))
-        
-        # Check if there is an inventory id
-        if worksheet.cell(row=index, column=2).value is not None:
-            inventory_id = worksheet.cell(row=index, column=2).value
-            logging.debug("Entry has Inventory Id: " + str(inventory_id))
-            
-            if args.skip:
-                index += 1
-                continue
-        else:
-            inventory_id = 0
-
-        item_type = worksheet.cell(row=index, column=3).value
-        logging.info('')
-        logging.info('Processing: '+ str(item_type))
-        if inventory_id:
-            logging.info("  Inventory Id: " + str(inventory_id))
-        item_num = worksheet.cell(row=index, column=4).value
-        logging.info("  Item Num: " + str(item_num))
-        color = worksheet.cell(row=index, column=6).value
-        logging.info("  Color: " + str(color))
-        price = worksheet.cell(row=index, column=7).value
-        logging.info("  Price: " + str(price))
-        quantity = worksheet.cell(row=index, column=8).value
-        logging.info("  Quantity: " + str(quantity))
-        condition = worksheet.cell(row=index, column=9).value
-        logging.debug("  Condition: " + str(condition))
-        description = worksheet.cell(row=index, column=12).value
-        logging.debug("  Description: " + str(description))
-        stockroom = worksheet.cell(row=index, column=15).value
-        logging.debug("  Stockroom: " + str(stockroom))
-        remark = worksheet.cell(row=index, column=14).value
-        logging.debug("  Remark: " + str(remark))
-        stockroom_id = worksheet.cell(row=index, column=16).value
-        logging.debug("  Stockroom Id: " + str(stockroom_id))
-        retain = worksheet.cell(row=index, column=17).value
-        logging.debug("  Stockroom Id: " + str(retain))
-
-        if item_num is None:
-            index += 1
-            logging.info('Empty row!!')
-            continue
-
-        if quantity == 0 or quantity is None:
-            logging.warning('No quantity provided or it\'s zero')
-            index += 1
-            continue
-
-        if color == 0 or color is None:
-            logging.warning('No color provided or it\'s zero')
-            index += 1
-            continue
-            
-        # Call Bricklink API
-        inventory_item = {}
-        inventory_item['item'] = {}
-        inventory_item['item']['type'] = item_type
-        inventory_item['item']['no'] = item_num
-        inventory_item['color_id'] = color
-        inventory_item['unit_price'] = price
-        
-        inventory_item['new_or_used'] = condition
-        inventory_item['description'] = description
-        inventory_item['is_stock_room'] = stockroom
-        inventory_item['stock_room_id'] = stockroom_id
-        inventory_item['is_retain'] = retain
-        inventory_item['remarks'] = configData[str(color)]['Name']
-        logging.debug(json.dumps(inventory_item, indent=4, sort_keys=True))
-
-        if inventory_id == 0:
-            logging.info('Creating Inventory Item')
-            # Get price details
-            try:
-                details = getPartDetails(item_num, auth)
-                if price is None:
-                    logging.debug(details)
-                    inventory_item['unit_price'] = details[item_num]['avg']
-                    if not args.dryrun:
-                        worksheet.cell(row=index, column=7).value = details[item_num]['avg']
-                    else:
-                        logging.info('  Avg Unit Price: ' + str(inventory_item['unit_price']))
-                if not args.dryrun:
-                    worksheet.cell(row=index, column=24).value = details[item_num]['name']
-                inventory_item['quantity'] = quantity
-            except Exception as e:
-                logging.warning('Could not get pricing details for ' + str(item_num))
-                logging.warning(details)
-                index += 1
-                continue
-            if not args.dryrun:
-                try:
-                    response = create_inventory(inventory_item, auth=auth)
-                    logging.debug(response)
-                    inventory_id = response['data']['inventory_id']
-                    unit_price = response['data']['unit_price']
-                    logging.info('  Inventory Id: ' + str(inventory_id))
-                    logging.info('  Avg Unit Price: ' + str(unit_price))
-                    worksheet.cell(row=index, column=2).value = inventory_id
-                except Exception as error:
-                    logging.warning('  Could not create inventory for '+ item_num)
-                    logging.warning(response)
-                    index += 1
-                    continue       
-            else:
-                logging.info('  ## Dry Run mode: no changes applied to Bricklink inventory ##')
-        else:
-            logging.info('Updating Inventory Item')
-
-            try:
-                details = getPartDetails(item_num, auth)
-                if not args.dryrun:
-                    worksheet.cell(row=index, column=24).value = details[item_num]['name']
-                    worksheet.cell(row=index, column=7).value = details[item_num]['avg']
-                else:
-                    logging.info('  Latest average price is ' + str(details[item_num]['avg']))
-                    if details[item_num]['avg'] > inventory_item['unit_price']:
-                        logging.info('  Price has increased')
-                    elif details[item_num]['avg'] < inventory_item['unit_price']:
-                        logging.info('  Price has decreased')
-                    else:
-                        logging.info('  Price has not changed')
+    try:
+        archive = replay.install(session, args.record, args.replay)
+    except Exception as error:
+        logging.error('Could not set up the response archive: ' + str(error))
+        sys.exit(1)
 
-            except Exception as e:
-                logging.warning('  Could not get pricing details for ' + str(item_num))
-                logging.warning(details)
-                index += 1
-                continue
-            # Get current online inventory quantities
-            curr = get_inventory(inventory_id, auth=auth)
-            logging.debug(curr)
-            curr_quantity = curr['data']['quantity']
+    if args.refresh_colors:
+        try:
+            color_registry.refresh(lambda: limiter.call(session.color.get_color_list), COLORS_FILE)
+        except Exception as e:
+            logging.critical("Could not refresh colors: " + str(e))
+            sys.exit(2)
 
-            # Update new quantity
-            if curr_quantity > quantity:
-                delta = curr_quantity - quantity
-                logging.info('  Increase quantity in spreadsheet by ' + str(delta))
-                inventory_item['quantity'] = delta
-                if not args.dryrun:
-                    worksheet.cell(row=index, column=8).value += delta
-            if curr_quantity < quantity:
-                delta = quantity - curr_quantity
-                logging.info('  Increase quantity in Bricklink by ' + str(delta))
-                inventory_item['quantity'] = delta
-            else:
-                logging.info('  No change in quantity')
+    category_index.preload(lambda: limiter.call(session.category.get_category_list))
 
-            if args.dryrun:
-                #logging.info(type(curr_quantity))
-                #logging.info(type(quantity))
-                logging.info('  Bricklink quantity: ' + str(curr_quantity))
-                logging.info('  Spreadsheet quantity: ' + str(quantity))
+    workbook = setup_xls_writer('LegoParts.xlsx')
 
-            logging.debug(inventory_item)
-            if not args.dryrun:
-                response = update_inventory(inventory_id, inventory_item, auth=auth)
-                logging.debug(response)
-            else:
-                logging.info('  ## Dry Run mode: no changes applied to Bricklink inventory ##')
+    worksheet = workbook['Inventory']
+    try:
+        process_inventory(worksheet, session, args)
+    except QuotaExceeded as e:
+        logging.error(str(e) + ', stopping early')
+    finally:
+        limiter.log_summary()
+        if archive:
+            archive.close()
+        # Keep the inventory ids of the items created so far, however the
+        # run ended, so the next run doesn't create them again
+        if not args.dryrun:
+            with profiler.stage('save'):
+                workbook.save(filename='LegoParts.xlsx')
+        profiler.finish()
 
-        index += 1
-    if not args.dryrun:
-        workbook.save(filename='LegoParts.xlsx')
+"""
+Sync the Inventory sheet with Bricklink, creating or updating each row.
+"""
+def process_inventory(worksheet, session, args):
+    sync = InventorySync(worksheet, session, color_registry, getPartDetails, dryrun=args.dryrun, skip=args.skip,
+                         workers=args.workers, writers=args.writers, bulk_snapshot=args.bulk_snapshot)
+    sync.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,160 @@
+"""
+Background jobs for the web app.
+
+/generate used to run sheet_handler inside the request, tying up a worker
+for the whole run. Jobs are instead queued on a bounded thread pool and the
+client follows their progress through /jobs/<id>. Log lines are collected
+as they are written, so they can be polled or streamed while the job runs.
+
+The running job is kept in a context variable and a single handler on the
+root logger sends each record to the job it was logged for, so jobs that run
+at the same time never see each other's output. Code that hands work to
+other threads must copy the context for this to follow (see
+generate_sheets.submit_in_context).
+"""
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+current_job = contextvars.ContextVar('current_job', default=None)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+
+    def __init__(self, description='', result_file=None):
+        self.id = uuid.uuid4().hex
+        self.description = description
+        self.result_file = result_file
+        self.status = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._lines = []
+        self._changed = threading.Condition()
+
+    @property
+    def finished_running(self):
+        return self.status in (DONE, FAILED)
+
+    def log(self, line):
+        with self._changed:
+            self._lines.append(line)
+            self._changed.notify_all()
+
+    def lines(self, since=0):
+        with self._changed:
+            return self._lines[since:]
+
+    def wait(self, since, timeout=None):
+        """
+        Block until there are lines after since or the job has finished.
+        Returns the new lines.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: len(self._lines) > since or self.finished_running, timeout)
+            return self._lines[since:]
+
+    def set_status(self, status, error=None):
+        with self._changed:
+            self.status = status
+            if status == RUNNING:
+                self.started = time.time()
+            elif status in (DONE, FAILED):
+                self.finished = time.time()
+                self.error = error
+            self._changed.notify_all()
+
+    def to_dict(self, since=0):
+        lines = self.lines(since)
+        return {
+            'id': self.id,
+            'description': self.description,
+            'status': self.status,
+            'error': self.error,
+            'output': '\n'.join(lines),
+            'next': since + len(lines),
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobLogHandler(logging.Handler):
+    """Logging handler that appends each record to the job it was logged for."""
+
+    def __init__(self, level=logging.INFO):
+        super().__init__(level)
+        self.setFormatter(logging.Formatter('%(message)s'))
+
+    def emit(self, record):
+        job = current_job.get()
+        if job is None:
+            return
+        try:
+            job.log(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class JobQueue:
+
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        logging.getLogger().addHandler(JobLogHandler())
+
+    def submit(self, fn, *args, description='', result_file=None, cleanup=None, **kwargs):
+        """
+        Queue fn(*args, **kwargs) and return its Job straight away.
+        cleanup is called once the job has finished, whatever the outcome.
+        """
+        job = Job(description, result_file)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args, kwargs, cleanup)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def expire(self, max_age):
+        """
+        Forget jobs that finished more than max_age seconds ago and return
+        them, so their output files can be removed.
+        """
+        cutoff = time.time() - max_age
+        with self._lock:
+            expired = [job for job in self._jobs.values()
+                       if job.finished_running and job.finished < cutoff]
+            for job in expired:
+                del self._jobs[job.id]
+        return expired
+
+    def _run(self, job, fn, args, kwargs, cleanup):
+        token = current_job.set(job)
+        job.set_status(RUNNING)
+        try:
+            fn(*args, **kwargs)
+        except SystemExit:
+            # sheet_handler exits on fatal errors, which must not kill the worker
+            job.set_status(FAILED, 'Generation stopped early, see the output for details')
+        except Exception as e:
+            logging.exception('Job ' + job.id + ' failed')
+            job.set_status(FAILED, str(e))
+        else:
+            job.set_status(DONE)
+        finally:
+            current_job.reset(token)
+            if cleanup:
+                cleanup()
@@ -0,0 +1,22 @@
+"""
+Logging helpers.
+"""
+import json
+
+
+class LazyJSON:
+    """
+    Log a value as indented JSON, e.g. logging.debug(LazyJSON(payload)).
+
+    Arguments to logging calls are evaluated even when the level is turned
+    off, and dumping a price guide with a long price_detail list is costly.
+    The value is only serialised when a handler formats the record, so at
+    INFO level the dump costs nothing.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, indent=4, sort_keys=True)
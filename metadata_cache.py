@@ -0,0 +1,157 @@
+"""
+Persistent on-disk cache for Bricklink catalog metadata.
+
+Item names, release years, image URLs and category names almost never
+change, so generate_sheets and inventory_update keep them in a small SQLite
+file instead of asking Bricklink on every run. Entries expire after a TTL
+and the least recently used entries are evicted once the cache grows past
+its size limit.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_FILE = 'bricklink_cache.sqlite'
+DEFAULT_TTL_DAYS = 30
+DEFAULT_MAX_ENTRIES = 50000
+DEFAULT_TABLE = 'metadata'
+
+# Eviction needs a COUNT(*), so only check the size every so many writes
+EVICT_EVERY = 100
+
+
+def item_key(item_type, number):
+    return 'item:' + str(item_type) + ':' + str(number)
+
+
+def category_key(category_id):
+    return 'category:' + str(category_id)
+
+
+class MetadataCache:
+    """
+    Key/value store of JSON documents with a TTL and LRU eviction.
+
+    Safe to share between threads. Several processes may also use the same
+    file at once, as SQLite handles the locking between them. Caches with
+    different TTLs can share a file by using their own table.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_FILE, ttl_days=DEFAULT_TTL_DAYS, max_entries=DEFAULT_MAX_ENTRIES,
+                 table=DEFAULT_TABLE):
+        self.path = path
+        self.table = table
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS ' + table + ' ('
+                               'key TEXT PRIMARY KEY, '
+                               'value TEXT NOT NULL, '
+                               'stored_at REAL NOT NULL, '
+                               'accessed_at REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS ' + table + '_accessed ON ' + table + ' (accessed_at)')
+            self._conn.execute('DELETE FROM ' + table + ' WHERE stored_at < ?', (time.time() - self.ttl,))
+            self._evict()
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT value, stored_at FROM ' + self.table + ' WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[1] < now - self.ttl:
+                self._conn.execute('DELETE FROM ' + self.table + ' WHERE key = ?', (key,))
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE ' + self.table + ' SET accessed_at = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO ' + self.table + ' (key, value, stored_at, accessed_at) '
+                               'VALUES (?, ?, ?, ?)', (key, json.dumps(value), now, now))
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self._evict()
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Return the cached value for key, calling fetch() and storing its
+        result on a miss. Exceptions from fetch are not cached.
+        """
+        value = self.get(key)
+        if value is None:
+            value = fetch()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    async def get_or_fetch_async(self, key, fetch):
+        """get_or_fetch for a coroutine function fetch."""
+        value = self.get(key)
+        if value is None:
+            value = await fetch()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _evict(self):
+        # Caller holds the lock and an open transaction
+        count = self._conn.execute('SELECT COUNT(*) FROM ' + self.table).fetchone()[0]
+        if count > self.max_entries:
+            logging.debug('Evicting ' + str(count - self.max_entries) + ' cache entries')
+            self._conn.execute('DELETE FROM ' + self.table + ' WHERE key IN ('
+                               'SELECT key FROM ' + self.table + ' ORDER BY accessed_at LIMIT ?)',
+                               (count - self.max_entries,))
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Set up the shared cache from the optional [cache] section of a
+    configparser object. Returns the shared cache.
+    """
+    global _shared_cache
+
+    section = config['cache'] if config.has_section('cache') else {}
+    path = section.get('path', DEFAULT_CACHE_FILE)
+    ttl_days = float(section.get('ttl_days', DEFAULT_TTL_DAYS))
+    max_entries = int(section.get('max_entries', DEFAULT_MAX_ENTRIES))
+
+    with _shared_lock:
+        if _shared_cache is None or _shared_cache.path != path:
+            _shared_cache = MetadataCache(path, ttl_days, max_entries)
+        else:
+            _shared_cache.ttl = ttl_days * 24 * 60 * 60
+            _shared_cache.max_entries = max_entries
+        return _shared_cache
+
+
+def get_cache():
+    """Return the shared cache, creating one with the defaults if needed."""
+    global _shared_cache
+
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = MetadataCache()
+        return _shared_cache
@@ -0,0 +1,67 @@
+"""
+Cache of part price guides for inventory_update.
+
+A store usually lists the same part in many colors and both conditions, and
+runs again every day or so, while part prices change slowly. Price guides
+are kept for each (part, color, condition, region) in their own table of
+the metadata cache file, with a much shorter TTL than the catalog metadata,
+so rows and runs that need the same price guide only ask Bricklink once.
+
+Only the summary of a price guide is cached, not its price_detail.
+"""
+import threading
+
+from metadata_cache import MetadataCache, DEFAULT_CACHE_FILE, DEFAULT_MAX_ENTRIES
+
+DEFAULT_TTL_DAYS = 1
+TABLE = 'prices'
+
+SUMMARY_FIELDS = ['avg_price', 'min_price', 'max_price', 'qty_avg_price', 'unit_quantity', 'total_quantity',
+                  'currency_code']
+
+
+def price_key(item_type, number, color_id, condition, region):
+    return 'price:' + str(item_type) + ':' + str(number) + ':' + str(color_id) + ':' + str(condition) + ':' + \
+        str(region)
+
+
+def summary(price_guide):
+    """The fields of a price guide that are cached."""
+    return {field: price_guide[field] for field in SUMMARY_FIELDS if field in price_guide}
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Set up the shared price cache from the optional [prices] section of a
+    configparser object. The file defaults to the one of the [cache]
+    section. Returns the shared cache.
+    """
+    global _shared_cache
+
+    cache_section = config['cache'] if config.has_section('cache') else {}
+    section = config['prices'] if config.has_section('prices') else {}
+    path = section.get('path', cache_section.get('path', DEFAULT_CACHE_FILE))
+    ttl_days = float(section.get('ttl_days', DEFAULT_TTL_DAYS))
+    max_entries = int(section.get('max_entries', DEFAULT_MAX_ENTRIES))
+
+    with _shared_lock:
+        if _shared_cache is None or _shared_cache.path != path:
+            _shared_cache = MetadataCache(path, ttl_days, max_entries, table=TABLE)
+        else:
+            _shared_cache.ttl = ttl_days * 24 * 60 * 60
+            _shared_cache.max_entries = max_entries
+        return _shared_cache
+
+
+def get_cache():
+    """Return the shared price cache, creating one with the defaults if needed."""
+    global _shared_cache
+
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = MetadataCache(DEFAULT_CACHE_FILE, DEFAULT_TTL_DAYS, DEFAULT_MAX_ENTRIES, table=TABLE)
+        return _shared_cache
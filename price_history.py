@@ -0,0 +1,282 @@
+"""
+Price history store.
+
+Every run of generate_sheets records the price guides it fetched in a
+SQLite file, one row per item, day, condition and guide type. History can
+then be queried by set or by date range without loading any workbooks, and
+the workbook export below is just a view over the store.
+
+  python price_history.py export -o History.xlsx [-s SET ...] [--from DATE] [--to DATE]
+  python price_history.py show -s SET [--from DATE] [--to DATE]
+
+Dates are ISO 8601 (YYYY-MM-DD). Running more than once on the same day
+replaces that day's rows.
+"""
+import argparse
+import configparser
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import date
+
+from openpyxl import Workbook
+
+from sheet_styles import CENTER_STYLE, HEADER_STYLE, register_styles, styled_row
+
+DEFAULT_HISTORY_FILE = 'price_history.sqlite'
+
+# generate_sheets only asks for new items; the guide types are Bricklink's
+NEW = 'N'
+USED = 'U'
+STOCK = 'stock'
+SOLD = 'sold'
+
+
+class PriceHistory:
+    """
+    Price guide snapshots keyed by (item, date, condition, guide type).
+
+    Safe to share between threads, and several processes can write to the
+    same file as SQLite handles the locking between them.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS prices ('
+                               'item TEXT NOT NULL, '
+                               'date TEXT NOT NULL, '
+                               'condition TEXT NOT NULL, '
+                               'guide_type TEXT NOT NULL, '
+                               'avg_price REAL, '
+                               'min_price REAL, '
+                               'max_price REAL, '
+                               'quantity INTEGER, '
+                               'currency TEXT, '
+                               'last_sale_date TEXT, '
+                               'stats TEXT, '
+                               'recorded_at REAL NOT NULL, '
+                               'PRIMARY KEY (item, date, condition, guide_type))')
+            # The primary key serves queries by item, this one date ranges
+            self._conn.execute('CREATE INDEX IF NOT EXISTS prices_date ON prices (date, item)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS items ('
+                               'item TEXT PRIMARY KEY, '
+                               'name TEXT, '
+                               'category TEXT, '
+                               'year INTEGER, '
+                               'image TEXT, '
+                               'thumbnail TEXT)')
+            # Stores made before these columns were added
+            add_missing_columns(self._conn, 'items', ('image', 'thumbnail'))
+            add_missing_columns(self._conn, 'prices', ('stats',))
+
+    def record(self, number, details, day=None):
+        """
+        Store the details of one set, as built by generate_sheets, under
+        day (today by default).
+        """
+        day = day or date.today().isoformat()
+        now = time.time()
+        rows = []
+        for guide_type, key in ((STOCK, 'current'), (SOLD, 'past')):
+            prices = details[key]
+            # The statistics from price_stats are worked out from the sales
+            stats = details.get('stats') if guide_type == SOLD else None
+            rows.append((number, day, NEW, guide_type, exact_price(prices, 'avg'), exact_price(prices, 'min'),
+                         exact_price(prices, 'max'),
+                         prices['quantity'], prices['currency'], prices.get('last_sale_date'),
+                         json.dumps(stats) if stats else None, now))
+
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO prices (item, date, condition, guide_type, avg_price, '
+                                   'min_price, max_price, quantity, currency, last_sale_date, stats, recorded_at) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._conn.execute('INSERT OR REPLACE INTO items (item, name, category, year, image, thumbnail) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (number, details['name'], details['category'], details['year'],
+                                details.get('image'), details.get('thumbnail')))
+
+    def history(self, number, start=None, end=None, condition=NEW, guide_type=STOCK):
+        """Snapshots of one item between start and end (inclusive), oldest first."""
+        query = ('SELECT * FROM prices WHERE item = ? AND condition = ? AND guide_type = ?' +
+                 date_range(start, end) + ' ORDER BY date')
+        return self._select(query, [number, condition, guide_type] + date_args(start, end))
+
+    def between(self, start=None, end=None, condition=NEW, guide_type=STOCK):
+        """Snapshots of every item between start and end, by date then item."""
+        query = ('SELECT * FROM prices WHERE condition = ? AND guide_type = ?' +
+                 date_range(start, end) + ' ORDER BY date, item')
+        return self._select(query, [condition, guide_type] + date_args(start, end))
+
+    def latest(self, number, condition=NEW, guide_type=STOCK):
+        """The most recent snapshot of an item, or None."""
+        rows = self.recent(number, 1, condition, guide_type)
+        return rows[0] if rows else None
+
+    def recent(self, number, count, condition=NEW, guide_type=STOCK):
+        """The last count snapshots of an item, newest first."""
+        return self._select('SELECT * FROM prices WHERE item = ? AND condition = ? AND guide_type = ? '
+                            'ORDER BY date DESC LIMIT ?', [number, condition, guide_type, count])
+
+    def totals(self, start=None, end=None, condition=NEW, guide_type=STOCK):
+        """(date, total average price) of all items for each day, oldest first."""
+        query = ('SELECT date, SUM(avg_price) AS total FROM prices WHERE condition = ? AND guide_type = ?' +
+                 date_range(start, end) + ' GROUP BY date ORDER BY date')
+        return [(row['date'], row['total'])
+                for row in self._select(query, [condition, guide_type] + date_args(start, end))]
+
+    def item(self, number):
+        """Name, category and year of an item, or None."""
+        rows = self._select('SELECT * FROM items WHERE item = ?', [number])
+        return rows[0] if rows else None
+
+    def items(self):
+        return [row['item'] for row in self._select('SELECT item FROM items ORDER BY item', [])]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _select(self, query, args):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(query, args)]
+
+
+def add_missing_columns(conn, table, columns):
+    existing = [row['name'] for row in conn.execute('PRAGMA table_info(' + table + ')')]
+    for column in columns:
+        if column not in existing:
+            conn.execute('ALTER TABLE ' + table + ' ADD COLUMN ' + column + ' TEXT')
+
+
+def exact_price(prices, key):
+    """
+    One of a guide's prices at Bricklink's precision, or the sheet's whole
+    number for details journaled before the exact prices were kept.
+    """
+    return prices.get(key + '_price', prices[key])
+
+
+def date_range(start, end):
+    clause = ''
+    if start:
+        clause += ' AND date >= ?'
+    if end:
+        clause += ' AND date <= ?'
+    return clause
+
+
+def date_args(start, end):
+    return [value for value in (start, end) if value]
+
+
+_shared_history = None
+_shared_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Set up the shared store from the optional [history] section of a
+    configparser object. Returns the shared store.
+    """
+    global _shared_history
+
+    section = config['history'] if config.has_section('history') else {}
+    path = section.get('path', DEFAULT_HISTORY_FILE)
+
+    with _shared_lock:
+        if _shared_history is None or _shared_history.path != path:
+            _shared_history = PriceHistory(path)
+        return _shared_history
+
+
+def get_history():
+    """Return the shared store, creating one with the defaults if needed."""
+    global _shared_history
+
+    with _shared_lock:
+        if _shared_history is None:
+            _shared_history = PriceHistory()
+        return _shared_history
+
+
+def export_workbook(history, xls_filename, numbers=None, start=None, end=None):
+    """
+    Write the history of numbers (every item by default) between start and
+    end to a workbook, with a sheet per item and a Summary sheet of daily
+    totals, laid out like the multi-sheet output of generate_sheets.
+    """
+    workbook = Workbook(write_only=True)
+    register_styles(workbook)
+
+    summary = workbook.create_sheet('Summary')
+    summary.column_dimensions['B'].width = 10
+    summary.column_dimensions['C'].width = 20
+    summary.append([])
+    summary.append(styled_row(summary, [None, 'Date', 'Total'], HEADER_STYLE))
+    for day, total in history.totals(start, end):
+        summary.append(styled_row(summary, [None, day, total], CENTER_STYLE))
+
+    for number in numbers or history.items():
+        rows = history.history(number, start, end)
+        if not rows:
+            logging.warning('No history for ' + number)
+            continue
+        info = history.item(number) or {}
+
+        # Sheet names are limited to 31 characters
+        worksheet = workbook.create_sheet(number[:31])
+        worksheet.column_dimensions['B'].width = 10
+        for column in 'CDEF':
+            worksheet.column_dimensions[column].width = 20
+        worksheet.append([])
+        worksheet.append(styled_row(worksheet, [None, 'Name', info.get('name')], HEADER_STYLE))
+        worksheet.append(styled_row(worksheet, [None, 'Category', info.get('category')], HEADER_STYLE))
+        worksheet.append([])
+        worksheet.append(styled_row(worksheet, [None, 'Date', 'Avg Price', 'Min Price', 'Max Price', 'Quantity'],
+                                    HEADER_STYLE))
+        for row in rows:
+            worksheet.append(styled_row(worksheet, [None, row['date'], row['avg_price'], row['min_price'],
+                                                    row['max_price'], row['quantity']], CENTER_STYLE))
+
+    workbook.save(filename=xls_filename)
+
+
+def main():
+    logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+    parser = argparse.ArgumentParser(description='Query the price history store')
+    parser.add_argument('command', choices=['export', 'show'])
+    parser.add_argument('-c', '--config', type=str, default='config.ini')
+    parser.add_argument('-s', '--set', type=str, action='append', help='set number, may be repeated')
+    parser.add_argument('--from', dest='start', type=str, help='first date, YYYY-MM-DD')
+    parser.add_argument('--to', dest='end', type=str, help='last date, YYYY-MM-DD')
+    parser.add_argument('-o', '--output', type=str, default='History.xlsx')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    history = configure(config)
+
+    if args.command == 'export':
+        export_workbook(history, args.output, args.set, args.start, args.end)
+        logging.info('Wrote ' + args.output)
+    else:
+        for number in args.set or history.items():
+            for row in history.history(number, args.start, args.end):
+                logging.info(number + ' ' + row['date'] + ': avg ' + str(row['avg_price']) + ' min ' +
+                             str(row['min_price']) + ' max ' + str(row['max_price']) + ' quantity ' +
+                             str(row['quantity']) + ' ' + str(row['currency']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Price statistics from the raw sales in Bricklink's sold price guide.
+
+Bricklink's price guide only summarises its sales as an average, a minimum
+and a maximum. The sales themselves are in price_detail, so getDetails keeps
+them as plain columns and this stage turns them into NumPy arrays and works
+out, for a whole batch of sets at once:
+  median, p10, p90    - of the unit prices
+  weighted_avg        - average unit price weighted by quantity
+  trimmed_mean        - mean with the cheapest and dearest 10% of sales dropped
+  velocity_<N>d       - units sold per day over the last N days
+  volatility_<N>d     - standard deviation of the unit price over the last
+                        N days, as a fraction of its mean
+
+Every statistic is computed over the flattened sales of the batch with
+segment-wise reductions, so there is no Python loop over sales and only a
+few NumPy calls per batch however many sets it has.
+"""
+import logging
+from datetime import date
+from itertools import chain
+
+import numpy as np
+
+from profiling import profiler
+
+# Most sets buffered by add_stats before their statistics are computed
+# together. Callers fetching live pass a smaller batch, so results aren't
+# held back waiting for slow fetches.
+DEFAULT_BATCH_SIZE = 256
+
+TRIM_FRACTION = 0.1
+WINDOWS = (30, 90)
+
+STAT_HEADERS = ['Median', 'P10', 'P90', 'Weighted Avg', 'Trimmed Mean', 'Sold/Day (30d)', 'Volatility (90d)']
+STAT_KEYS = ['median', 'p10', 'p90', 'weighted_avg', 'trimmed_mean', 'velocity_30d', 'volatility_90d']
+
+
+def sales_columns(price_detail, item=None):
+    """
+    Keep the date, unit price and quantity of each sale in price_detail as
+    three JSON friendly lists, so they can be journaled with the details.
+    Sales with a missing or malformed date, price or quantity are left out,
+    and logged with item, so one bad sale can't fail the batch.
+    """
+    dates = []
+    prices = []
+    quantities = []
+    skipped = 0
+    for sale in price_detail:
+        try:
+            day = sale['date_ordered'][:10]
+            date.fromisoformat(day)
+            price = float(sale['unit_price'])
+            quantity = int(sale.get('quantity', 1))
+        except (KeyError, TypeError, ValueError):
+            skipped += 1
+            continue
+        if price != price:
+            skipped += 1
+            continue
+        dates.append(day)
+        prices.append(price)
+        quantities.append(quantity)
+    if skipped:
+        logging.warning('Left ' + str(skipped) + ' of ' + str(len(price_detail)) + ' sales' +
+                        (' of ' + str(item) if item else '') +
+                        ' out of the statistics, for a missing or malformed date, price or quantity')
+    return {'date': dates, 'price': prices, 'quantity': quantities}
+
+
+def batch_stats(sales, today=None):
+    """
+    Compute the statistics for a list of sales_columns dicts. Returns a list
+    of dicts in the same order, with None for statistics that an item has
+    no sales for.
+    """
+    today = np.datetime64(today or date.today(), 'D')
+    count = len(sales)
+    lengths = np.array([len(item['price']) for item in sales], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if count else lengths
+    segment = np.repeat(np.arange(count), lengths)
+
+    total = int(lengths.sum())
+    price = np.fromiter(chain.from_iterable(item['price'] for item in sales), dtype=np.float64, count=total)
+    quantity = np.fromiter(chain.from_iterable(item['quantity'] for item in sales), dtype=np.float64, count=total)
+    day = np.array(list(chain.from_iterable(item['date'] for item in sales)), dtype='datetime64[D]')
+
+    # Sorting by segment then price puts each item's prices in order at
+    # starts[i] .. starts[i] + lengths[i]
+    order = np.lexsort((price, segment))
+    sorted_price = price[order]
+    has_sales = lengths > 0
+
+    stats = {
+        'median': percentile(sorted_price, starts, lengths, 0.5),
+        'p10': percentile(sorted_price, starts, lengths, 0.1),
+        'p90': percentile(sorted_price, starts, lengths, 0.9),
+        'weighted_avg': ratio(np.bincount(segment, price * quantity, count), np.bincount(segment, quantity, count)),
+        'trimmed_mean': trimmed_mean(sorted_price, segment, starts, lengths, count),
+    }
+    for window in WINDOWS:
+        recent = day > today - np.timedelta64(window, 'D')
+        stats['velocity_' + str(window) + 'd'] = np.where(
+            has_sales, np.bincount(segment, quantity * recent, count) / window, np.nan)
+        stats['volatility_' + str(window) + 'd'] = volatility(price, segment, recent, count)
+
+    columns = {key: rounded(values) for key, values in stats.items()}
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def percentile(sorted_price, starts, lengths, q):
+    """Linearly interpolated percentile of each segment, like np.percentile."""
+    position = (np.maximum(lengths, 1) - 1) * q
+    low = np.floor(position).astype(np.int64)
+    high = np.ceil(position).astype(np.int64)
+    if len(sorted_price) == 0:
+        return np.full(len(lengths), np.nan)
+    # Empty segments index a valid element and are masked out afterwards
+    last = len(sorted_price) - 1
+    low_value = sorted_price[np.minimum(starts + low, last)]
+    high_value = sorted_price[np.minimum(starts + high, last)]
+    value = low_value + (high_value - low_value) * (position - low)
+    return np.where(lengths > 0, value, np.nan)
+
+
+def trimmed_mean(sorted_price, segment, starts, lengths, count):
+    trim = np.floor(lengths * TRIM_FRACTION).astype(np.int64)
+    # segment is already in sorted order, as sorting never crosses segments
+    rank = np.arange(len(sorted_price)) - starts[segment]
+    keep = (rank >= trim[segment]) & (rank < (lengths - trim)[segment])
+    return ratio(np.bincount(segment[keep], sorted_price[keep], count), lengths - 2 * trim)
+
+
+def volatility(price, segment, mask, count):
+    n = np.bincount(segment, mask, count)
+    total = np.bincount(segment, price * mask, count)
+    squares = np.bincount(segment, price * price * mask, count)
+    mean = ratio(total, n)
+    variance = np.maximum(ratio(squares, n) - mean * mean, 0)
+    return ratio(np.sqrt(variance), mean)
+
+
+def ratio(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / np.where(denominator > 0, denominator, 1), np.nan)
+
+
+def rounded(values):
+    """Round to cents and turn NaN into None, for the sheets and JSON."""
+    return [None if value != value else value for value in np.round(values, 2).tolist()]
+
+
+def add_stats(details, batch_size=DEFAULT_BATCH_SIZE, today=None):
+    """
+    Add a 'stats' dict to the details of each set coming from fetch_details,
+    computing a batch of sets at a time, and drop the raw sales once they
+    have been used. Yields the same (set_number, details) pairs in order.
+    """
+    batch = []
+    for number, res in details:
+        batch.append((number, res))
+        if len(batch) >= batch_size:
+            yield from stats_for_batch(batch, today)
+            batch = []
+    yield from stats_for_batch(batch, today)
+
+
+def stats_for_batch(batch, today):
+    with profiler.stage('stats'):
+        items = [item for number, res in batch for item in res.values() if 'sales' in item['past']]
+        for item, stats in zip(items, batch_stats([item['past'].pop('sales') for item in items], today)):
+            item['stats'] = stats
+    return batch
+
+
+def stat_values(details):
+    """The statistics of one set's details in STAT_HEADERS order."""
+    stats = details.get('stats') or {}
+    return [stats.get(key) for key in STAT_KEYS]
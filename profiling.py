@@ -0,0 +1,130 @@
+"""
+Per-stage timing of a run, for --profile.
+
+A run mixes Bricklink calls, turning their payloads into details, logging,
+writing cells and saving the workbook. With --profile each of these stages
+records its wall time and how often it ran, Bricklink calls are timed per
+endpoint by the rate limiter, and the run ends with a table of where the
+time went. --cprofile also writes a cProfile dump of the main thread, for
+snakeviz or pstats.
+
+Stages that run on worker threads overlap each other, so their totals can
+add up to more than the run took. "fetch wait" is the time the main thread
+spent waiting for fetched sets, which is what the workers cost the run.
+
+The profiler is off unless enabled, and then every stage is a no-op.
+"""
+import cProfile
+import logging
+import threading
+import time
+
+
+class _Stage:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_STAGE = _NoStage()
+
+
+class Profiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.cprofile_path = None
+        # stage name -> [calls, seconds]
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._started = None
+        self._cprofile = None
+
+    def enable(self, cprofile_path=None):
+        """Start timing stages, and the main thread with cProfile if cprofile_path is given."""
+        self.enabled = True
+        self._started = time.perf_counter()
+        self.cprofile_path = cprofile_path
+        if cprofile_path:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def add(self, name, seconds, calls=1):
+        with self._lock:
+            stage = self._stages.setdefault(name, [0, 0.0])
+            stage[0] += calls
+            stage[1] += seconds
+
+    def stage(self, name):
+        """Context manager that times one run of a stage."""
+        return _Stage(self, name) if self.enabled else NO_STAGE
+
+    def iterate(self, name, iterable):
+        """Iterate over iterable, timing how long each item took to arrive as a stage."""
+        if not self.enabled:
+            return iterable
+        return self._timed_iterator(name, iterable)
+
+    def _timed_iterator(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start, 0)
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def stages(self):
+        """(name, calls, seconds) for every stage, the slowest first."""
+        with self._lock:
+            return sorted(((name, calls, seconds) for name, (calls, seconds) in self._stages.items()),
+                          key=lambda stage: -stage[2])
+
+    def finish(self):
+        """Log the table of stages and write the cProfile dump, if profiling."""
+        if not self.enabled:
+            return
+        if self._cprofile:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+            logging.info('Wrote cProfile stats to ' + self.cprofile_path)
+            self._cprofile = None
+        elapsed = time.perf_counter() - self._started
+
+        logging.info('Profile of a ' + '%.2f' % elapsed + 's run (stages on worker threads overlap):')
+        logging.info('  %-36s %8s %10s %10s' % ('stage', 'calls', 'total s', 'mean ms'))
+        for name, calls, seconds in self.stages():
+            mean = '%10.2f' % (1000 * seconds / calls) if calls else '%10s' % '-'
+            logging.info('  %-36s %8d %10.2f %s' % (name, calls, seconds, mean))
+
+
+def api_stage(fn, kwargs):
+    """Stage name of a Bricklink call: the endpoint method, and the guide type of price guides."""
+    name = 'api ' + getattr(fn, '__name__', str(fn))
+    if kwargs.get('guide_type'):
+        name += ' ' + kwargs['guide_type']
+    return name
+
+
+profiler = Profiler()
@@ -0,0 +1,382 @@
+"""
+Client-side rate limiting for Bricklink API calls.
+
+Every call to Bricklink goes through the shared limiter, which
+  - spaces calls out with a token bucket (calls_per_second, burst),
+  - counts calls against a daily budget that is kept in a small state file
+    so separate runs on the same day add up,
+  - retries throttled (429) and server error (5xx) responses with jittered
+    exponential backoff, halving the call rate while Bricklink is
+    throttling and slowly restoring it afterwards.
+
+Several runs can share the limiter, like the jobs of the web app. Each run
+counts its own calls within a run() block, for its summary.
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from profiling import api_stage, profiler
+
+DEFAULT_CALLS_PER_SECOND = 5.0
+DEFAULT_BURST = 10
+DEFAULT_DAILY_BUDGET = 5000
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+DEFAULT_STATE_FILE = 'bricklink_usage.json'
+
+# Warn once when the day's usage passes each of these fractions of the budget
+BUDGET_WARNINGS = (0.5, 0.8, 0.9)
+
+# Save the daily count every so many calls rather than on every call
+SAVE_EVERY = 10
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class RunCounters:
+    """The calls, retries, throttled calls and failures of one run."""
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+
+
+# Counters of the run the current code is part of. Worker threads and tasks
+# see them through their copy of the context.
+_current_run = contextvars.ContextVar('bricklink_run', default=None)
+
+
+def status_code(error):
+    """Return the HTTP or Bricklink status code carried by an error, if any."""
+    code = getattr(error, 'status_code', None)
+    if code is None:
+        response = getattr(error, 'response', None)
+        code = getattr(response, 'status_code', None)
+    return code
+
+
+def is_throttled(code):
+    return code == 429
+
+
+def is_retryable(code):
+    return code is not None and (code == 429 or code >= 500)
+
+
+def response_code(result):
+    """Status code of a bricklink_api style {'meta': ..., 'data': ...} response."""
+    if isinstance(result, dict) and isinstance(result.get('meta'), dict):
+        return result['meta'].get('code')
+    return None
+
+
+class RateLimiter:
+
+    def __init__(self, calls_per_second=DEFAULT_CALLS_PER_SECOND, burst=DEFAULT_BURST,
+                 daily_budget=DEFAULT_DAILY_BUDGET, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX,
+                 state_file=None):
+        self._lock = threading.Lock()
+        self.calls_per_second = calls_per_second
+        self.rate = calls_per_second
+        self.burst = burst
+        self.daily_budget = daily_budget
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.state_file = state_file
+        # Set when calls are served locally and never reach Bricklink
+        self.offline = False
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+        # Counters for this process
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+
+        self._day = None
+        self.calls_today = 0
+        self._warned = set()
+        self._load_state()
+
+    def reserve(self):
+        """
+        Take a token and count the call against the daily budget.
+        Returns how many seconds the caller must wait before calling.
+        Raises QuotaExceeded once the daily budget is used up. Offline
+        calls are only counted for this run.
+        """
+        with self._lock:
+            run = _current_run.get()
+            if self.offline:
+                self.calls += 1
+                if run:
+                    run.calls += 1
+                return 0.0
+            self._roll_day()
+            if self.daily_budget and self.calls_today >= self.daily_budget:
+                raise QuotaExceeded('Daily Bricklink budget of ' + str(self.daily_budget) + ' calls used up')
+
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            delay = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+            self.calls += 1
+            if run:
+                run.calls += 1
+            self.calls_today += 1
+            self._check_budget()
+            if self.calls_today % SAVE_EVERY == 0:
+                self._save_state()
+        return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def backoff(self, attempt):
+        """Jittered exponential delay before retry number attempt (from 0)."""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, fn, *args, **kwargs):
+        """Call fn, retrying throttled and 5xx responses."""
+        return self._call(fn, args, kwargs, is_retryable)
+
+    def write(self, fn, *args, **kwargs):
+        """
+        Call fn for a request that changes data on Bricklink. A 5xx response
+        may still have been applied, so only throttled calls are retried.
+        """
+        return self._call(fn, args, kwargs, is_throttled)
+
+    async def call_async(self, fn, *args, **kwargs):
+        """
+        Await fn(*args, **kwargs), retrying throttled and 5xx responses like
+        call(). Waits are awaited, so other calls on the loop keep running.
+        """
+        attempt = 0
+        while True:
+            delay = self.reserve()
+            if delay > 0:
+                with profiler.stage('rate limit wait'):
+                    await asyncio.sleep(delay)
+            try:
+                with profiler.stage(api_stage(fn, kwargs)):
+                    result = await fn(*args, **kwargs)
+            except QuotaExceeded:
+                raise
+            except Exception as e:
+                reason = self._check_error(e, attempt, is_retryable)
+            else:
+                reason = self._check_result(result, attempt, is_retryable)
+                if reason is None:
+                    return result
+            with profiler.stage('retry backoff'):
+                await asyncio.sleep(self._retry_delay(attempt, reason))
+            attempt += 1
+
+    def _call(self, fn, args, kwargs, should_retry):
+        attempt = 0
+        while True:
+            with profiler.stage('rate limit wait'):
+                self.acquire()
+            try:
+                with profiler.stage(api_stage(fn, kwargs)):
+                    result = fn(*args, **kwargs)
+            except QuotaExceeded:
+                raise
+            except Exception as e:
+                reason = self._check_error(e, attempt, should_retry)
+            else:
+                reason = self._check_result(result, attempt, should_retry)
+                if reason is None:
+                    return result
+            with profiler.stage('retry backoff'):
+                time.sleep(self._retry_delay(attempt, reason))
+            attempt += 1
+
+    def _check_error(self, error, attempt, should_retry):
+        """
+        Decide whether a call that raised error is tried again. Re-raises
+        it if not, otherwise returns the reason to log.
+        """
+        code = status_code(error)
+        retry = should_retry(code) if code is not None else isinstance(error, OSError)
+        self._record_failure(code)
+        if not retry or attempt >= self.max_retries:
+            raise error
+        return str(error)
+
+    def _check_result(self, result, attempt, should_retry):
+        """
+        Return None if result should be returned to the caller, otherwise
+        the reason to log before trying again.
+        """
+        code = response_code(result)
+        if not should_retry(code):
+            self._record_success()
+            return None
+        self._record_failure(code)
+        if attempt >= self.max_retries:
+            return None
+        return 'status ' + str(code)
+
+    def _retry_delay(self, attempt, reason):
+        delay = self.backoff(attempt)
+        with self._lock:
+            self.retries += 1
+            run = _current_run.get()
+            if run:
+                run.retries += 1
+        logging.warning('Bricklink call failed (' + reason + '), retry ' + str(attempt + 1) +
+                        ' in ' + str(round(delay, 1)) + 's')
+        return delay
+
+    def _record_success(self):
+        with self._lock:
+            # Creep back up to the configured rate after throttling
+            if self.rate < self.calls_per_second:
+                self.rate = min(self.calls_per_second, self.rate + self.calls_per_second / 20)
+
+    def _record_failure(self, code):
+        with self._lock:
+            self.failures += 1
+            run = _current_run.get()
+            if run:
+                run.failures += 1
+            if is_throttled(code):
+                self.throttled += 1
+                if run:
+                    run.throttled += 1
+                self.rate = max(self.calls_per_second / 16, self.rate / 2)
+
+    @contextlib.contextmanager
+    def run(self):
+        """
+        Count the calls made in this block, including those on worker
+        threads and tasks started from it, apart from the rest of the
+        process. Yields the RunCounters.
+        """
+        counters = RunCounters()
+        token = _current_run.set(counters)
+        try:
+            yield counters
+        finally:
+            _current_run.reset(token)
+
+    def stats(self):
+        """
+        The limiter's counters. calls, retries, throttled and failures are
+        those of the current run, or of the whole process outside of one.
+        """
+        run = _current_run.get() or self
+        with self._lock:
+            return {
+                'calls': run.calls,
+                'retries': run.retries,
+                'throttled': run.throttled,
+                'failures': run.failures,
+                'calls_today': self.calls_today,
+                'daily_budget': self.daily_budget,
+                'remaining_today': max(0, self.daily_budget - self.calls_today) if self.daily_budget else None,
+            }
+
+    def log_summary(self):
+        stats = self.stats()
+        message = ('API calls: ' + str(stats['calls']) + ' this run, ' + str(stats['retries']) + ' retries, ' +
+                   str(stats['throttled']) + ' throttled. Today: ' + str(stats['calls_today']))
+        if self.daily_budget:
+            message += (' of ' + str(self.daily_budget) + ' (' +
+                        str(round(100 * stats['calls_today'] / self.daily_budget)) + '%)')
+        logging.info(message)
+        with self._lock:
+            self._save_state()
+
+    def _roll_day(self):
+        today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        if self._day != today:
+            self._day = today
+            self.calls_today = 0
+            self._warned = set()
+
+    def _check_budget(self):
+        if not self.daily_budget:
+            return
+        used = self.calls_today / self.daily_budget
+        for level in BUDGET_WARNINGS:
+            if used >= level and level not in self._warned:
+                self._warned.add(level)
+                logging.warning('Used ' + str(round(100 * used)) + '% of the daily Bricklink budget (' +
+                                str(self.calls_today) + ' of ' + str(self.daily_budget) + ' calls)')
+
+    def _load_state(self):
+        self._roll_day()
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError) as e:
+            logging.warning('Could not read ' + self.state_file + ': ' + str(e))
+            return
+        if state.get('date') == self._day:
+            self.calls_today = state.get('calls', 0)
+
+    def _save_state(self):
+        # Caller holds the lock
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, 'w') as f:
+                json.dump({'date': self._day, 'calls': self.calls_today}, f)
+        except IOError as e:
+            logging.warning('Could not write ' + self.state_file + ': ' + str(e))
+
+
+limiter = RateLimiter()
+
+
+def configure(config):
+    """
+    Apply the optional [limits] section of a configparser object to the
+    shared limiter. Returns the shared limiter.
+    """
+    section = config['limits'] if config.has_section('limits') else {}
+    state_file = section.get('state_file', DEFAULT_STATE_FILE)
+
+    with limiter._lock:
+        calls_per_second = float(section.get('calls_per_second', DEFAULT_CALLS_PER_SECOND))
+        if calls_per_second != limiter.calls_per_second:
+            limiter.calls_per_second = calls_per_second
+            limiter.rate = calls_per_second
+        limiter.burst = int(section.get('burst', DEFAULT_BURST))
+        limiter.daily_budget = int(section.get('daily_budget', DEFAULT_DAILY_BUDGET))
+        limiter.max_retries = int(section.get('max_retries', DEFAULT_MAX_RETRIES))
+        limiter.backoff_base = float(section.get('backoff_base', DEFAULT_BACKOFF_BASE))
+        limiter.backoff_max = float(section.get('backoff_max', DEFAULT_BACKOFF_MAX))
+        reload_state = state_file != limiter.state_file
+        limiter.state_file = state_file
+
+    if reload_state:
+        limiter._load_state()
+    return limiter
@@ -0,0 +1,138 @@
+"""
+Incremental refresh of set lists.
+
+Many sets in a list are retired and their price guides barely change from
+one day to the next. With --incremental, each set's last snapshot in the
+price history is checked against a freshness policy first, and sets that
+are still fresh are written from the snapshot instead of fetching both of
+their price guides again.
+
+A snapshot is fresh while it is younger than max_age_days. Quiet sets get
+longer, up to quiet_max_age_days: a set is quiet when its last sale date
+and quantities didn't change between its last two snapshots, or when it
+hadn't sold for quiet_sale_days when the snapshot was taken.
+"""
+import json
+import logging
+import threading
+from datetime import date
+
+import price_history
+
+DEFAULT_MAX_AGE_DAYS = 1
+DEFAULT_QUIET_MAX_AGE_DAYS = 7
+DEFAULT_QUIET_SALE_DAYS = 90
+
+# Every fresh set saves its current and past price guide calls
+CALLS_PER_SET = 2
+
+
+class FreshnessPolicy:
+
+    def __init__(self, max_age_days=DEFAULT_MAX_AGE_DAYS, quiet_max_age_days=DEFAULT_QUIET_MAX_AGE_DAYS,
+                 quiet_sale_days=DEFAULT_QUIET_SALE_DAYS):
+        self.max_age_days = max_age_days
+        self.quiet_max_age_days = quiet_max_age_days
+        self.quiet_sale_days = quiet_sale_days
+
+    def is_fresh(self, stock, sold, today):
+        """
+        stock and sold are the last two snapshots of each price guide,
+        newest first, as returned by PriceHistory.recent.
+        """
+        snapshot_day = date.fromisoformat(stock[0]['date'])
+        age = (today - snapshot_day).days
+        if age < self.max_age_days:
+            return True
+        return age < self.quiet_max_age_days and self.is_quiet(stock, sold, snapshot_day)
+
+    def is_quiet(self, stock, sold, snapshot_day):
+        last_sale = sold[0]['last_sale_date']
+        if last_sale and (snapshot_day - date.fromisoformat(last_sale[:10])).days >= self.quiet_sale_days:
+            return True
+        if len(stock) < 2 or len(sold) < 2:
+            return False
+        return (last_sale == sold[1]['last_sale_date'] and
+                stock[0]['quantity'] == stock[1]['quantity'] and
+                sold[0]['quantity'] == sold[1]['quantity'])
+
+
+policy = FreshnessPolicy()
+
+
+def configure(config):
+    """
+    Apply the optional [refresh] section of a configparser object to the
+    shared policy. Returns the shared policy.
+    """
+    section = config['refresh'] if config.has_section('refresh') else {}
+    policy.max_age_days = int(section.get('max_age_days', DEFAULT_MAX_AGE_DAYS))
+    policy.quiet_max_age_days = int(section.get('quiet_max_age_days', DEFAULT_QUIET_MAX_AGE_DAYS))
+    policy.quiet_sale_days = int(section.get('quiet_sale_days', DEFAULT_QUIET_SALE_DAYS))
+    return policy
+
+
+class IncrementalRefresh:
+    """Decides, set by set, whether a run can reuse the last snapshot."""
+
+    def __init__(self, history=None, freshness=None, today=None):
+        self.history = history or price_history.get_history()
+        self.policy = freshness or policy
+        self.today = today or date.today()
+        self.reused = 0
+        self._lock = threading.Lock()
+
+    def reuse(self, number):
+        """
+        Return the details of number rebuilt from its last snapshot if that
+        is still fresh, otherwise None.
+        """
+        stock = self.history.recent(number, 2, guide_type=price_history.STOCK)
+        sold = self.history.recent(number, 2, guide_type=price_history.SOLD)
+        info = self.history.item(number)
+        if not stock or not sold or not info or stock[0]['date'] != sold[0]['date']:
+            return None
+        if not self.policy.is_fresh(stock, sold, self.today):
+            return None
+
+        with self._lock:
+            self.reused += 1
+        logging.debug('Reusing the ' + stock[0]['date'] + ' snapshot of ' + number)
+        return {number: snapshot_details(stock[0], sold[0], info)}
+
+    @property
+    def skipped_calls(self):
+        return self.reused * CALLS_PER_SET
+
+    def log_summary(self):
+        logging.info('Incremental refresh: reused ' + str(self.reused) + ' sets, skipping ' +
+                     str(self.skipped_calls) + ' price guide calls')
+
+
+def snapshot_details(stock, sold, info):
+    """Details in the shape built by generate_sheets.build_details."""
+    return {
+        'name': info['name'],
+        'category': info['category'],
+        'current': guide_details(stock),
+        'past': dict(guide_details(sold), last_sale_date=sold['last_sale_date']),
+        'year': info['year'],
+        'image': info['image'],
+        'thumbnail': info['thumbnail'],
+        'stats': json.loads(sold['stats']) if sold.get('stats') else None,
+        # Tells the writers not to record the snapshot again as today's
+        'snapshot_date': stock['date'],
+    }
+
+
+def guide_details(row):
+    return {
+        'avg': round(row['avg_price']),
+        'max': round(row['max_price']),
+        'min': round(row['min_price']),
+        'avg_price': row['avg_price'],
+        'max_price': row['max_price'],
+        'min_price': row['min_price'],
+        'quantity': row['quantity'],
+        'currency': row['currency'],
+    }
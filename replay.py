@@ -0,0 +1,198 @@
+"""
+Record and replay of Bricklink responses.
+
+With --record every response the Bricklink session gets is also written to
+a gzip compressed archive of JSON lines. With --replay the session is
+served from that archive instead and never touches the network, so a
+workbook can be rebuilt with a new layout, or the writer stages profiled
+on their own, without using any of the daily budget or waiting on
+Bricklink.
+
+Both work as requests transport adapters mounted on the shared session, so
+everything built on it (bricklink_py, the rate limiter, the caches) runs
+unchanged. Responses are matched on method, path, query and body; when a
+request was recorded more than once the latest response is replayed.
+Throttled and failed responses are not recorded, so the retried call that
+succeeded is the one replayed.
+
+A replayed run is not a new look at Bricklink's prices, so generate_sheets
+adds neither its price guides to the payload archive nor its sets to the
+price history.
+
+The asyncio client doesn't use the session and can't be recorded or
+replayed.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from rate_limit import is_retryable, limiter, response_code
+
+DEFAULT_ARCHIVE = 'bricklink_responses.jsonl.gz'
+
+# Recorded responses are flushed to disk this often, so an interrupted
+# recording keeps everything but the last few
+FLUSH_EVERY = 100
+
+
+class ReplayMiss(Exception):
+    """A request that isn't in the archive being replayed."""
+
+
+def request_key(method, url, body=None):
+    parts = urlsplit(url)
+    key = method + ' ' + parts.path + '?' + urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    if body:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        key += ' ' + hashlib.sha1(body).hexdigest()
+    return key
+
+
+class ResponseArchive:
+
+    def __init__(self, path=DEFAULT_ARCHIVE):
+        self.path = path
+        self.recorded = 0
+        self.replayed = 0
+        self._responses = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read every recorded response, keeping the latest one for each request."""
+        responses = {}
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as archive:
+                for line in archive:
+                    entry = json.loads(line)
+                    responses[entry['key']] = entry
+        except (EOFError, gzip.BadGzipFile, ValueError) as e:
+            # The end of an interrupted recording, keep what was read
+            logging.warning('Stopped reading ' + self.path + ' at a damaged entry: ' + str(e))
+        logging.info('Loaded ' + str(len(responses)) + ' recorded responses from ' + self.path)
+        self._responses = responses
+
+    def lookup(self, request):
+        if self._responses is None:
+            self.load()
+        entry = self._responses.get(request_key(request.method, request.url, request.body))
+        if entry is not None:
+            with self._lock:
+                self.replayed += 1
+        return entry
+
+    def record(self, request, response):
+        if is_retryable(response.status_code) or is_retryable(body_code(response)):
+            return
+        entry = {
+            'key': request_key(request.method, request.url, request.body),
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {'Content-Type': response.headers.get('Content-Type', 'application/json')},
+            'body': response.content.decode('utf-8', 'replace'),
+        }
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, 'at', encoding='utf-8')
+            self._file.write(line)
+            self.recorded += 1
+            if self.recorded % FLUSH_EVERY == 0:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self.recorded:
+            logging.info('Recorded ' + str(self.recorded) + ' responses to ' + self.path)
+        if self.replayed:
+            logging.info('Replayed ' + str(self.replayed) + ' responses from ' + self.path)
+
+
+def body_code(response):
+    """The status code in the meta of a Bricklink response body, if any."""
+    try:
+        return response_code(response.json())
+    except ValueError:
+        return None
+
+
+class RecordingAdapter(BaseAdapter):
+    """Sends requests with adapter and records every response in archive."""
+
+    def __init__(self, archive, adapter):
+        super().__init__()
+        self.archive = archive
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+        self.archive.record(request, response)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answers requests from archive, without any network calls."""
+
+    def __init__(self, archive):
+        super().__init__()
+        self.archive = archive
+
+    def send(self, request, **kwargs):
+        entry = self.archive.lookup(request)
+        if entry is None:
+            raise ReplayMiss(request.method + ' ' + request.url + ' was not recorded in ' + self.archive.path)
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry.get('reason')
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def install(session, record=None, replay=None):
+    """
+    Record the responses of a Bricklink session to the archive at record,
+    or serve them from the archive at replay. Returns the archive, which
+    should be closed at the end of the run, or None if neither is given.
+    """
+    oauth_session = session.oauth_session
+    if replay:
+        if not os.path.isfile(replay):
+            raise IOError('No recorded responses at ' + replay)
+        archive = ResponseArchive(replay)
+        archive.load()
+        adapter = ReplayAdapter(archive)
+        # Nothing reaches Bricklink, so nothing is rate limited or counted
+        limiter.offline = True
+        logging.info('Replaying Bricklink responses from ' + replay)
+    elif record:
+        archive = ResponseArchive(record)
+        adapter = RecordingAdapter(archive, oauth_session.get_adapter('https://'))
+        logging.info('Recording Bricklink responses to ' + record)
+    else:
+        return None
+    oauth_session.mount('https://', adapter)
+    oauth_session.mount('http://', adapter)
+    return archive
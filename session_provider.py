@@ -0,0 +1,143 @@
+"""
+Long-lived, shared Bricklink sessions.
+
+Building a Bricklink client means reading config.ini and starting a new
+OAuth session, and every new session has to open fresh TLS connections.
+The provider keeps one client per config file for the life of the process
+and only rebuilds it when the credentials in the file change. The client's
+HTTP session keeps a pool of keep-alive connections large enough for the
+concurrent fetches in generate_sheets, and is shared by generate_sheets,
+inventory_update and every request of the web app.
+"""
+import configparser
+import logging
+import os
+import threading
+
+from bricklink_py import Bricklink
+from bricklink_py import utils as bricklink_utils
+from requests.adapters import HTTPAdapter
+
+import metadata_cache
+import payload_archive
+import price_cache
+import price_history
+import rate_limit
+import refresh
+
+SECRET_KEYS = ('consumer_key', 'consumer_secret', 'token_value', 'token_secret')
+
+# Enough keep-alive connections for the requests getDetails runs in parallel.
+# fetch_details grows the pool when it runs more workers than this allows.
+DEFAULT_POOL_SIZE = 32
+
+DEFAULT_BASE_URL = bricklink_utils.API_BASE_URL
+
+
+class SessionProvider:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # config file -> (file stamp, credentials, session)
+        self._sessions = {}
+
+    def get_session(self, config_file='config.ini'):
+        """
+        Return the shared session for config_file. The file is only parsed
+        again when it has changed on disk, and a new session is only built
+        when the credentials in it have changed.
+        """
+        stamp = file_stamp(config_file)
+        with self._lock:
+            cached = self._sessions.get(config_file)
+            if cached and cached[0] == stamp:
+                return cached[2]
+
+            config = configparser.ConfigParser()
+            config.read(config_file)
+            metadata_cache.configure(config)
+            payload_archive.configure(config)
+            price_cache.configure(config)
+            price_history.configure(config)
+            rate_limit.configure(config)
+            refresh.configure(config)
+            bricklink_utils.API_BASE_URL = base_url(config)
+
+            # fill in with your data from https://www.bricklink.com/v2/api/register_consumer.page
+            credentials = tuple(config['secrets'][key] for key in SECRET_KEYS)
+            if cached and cached[1] == credentials:
+                session = cached[2]
+            else:
+                logging.debug('Creating Bricklink session for ' + config_file)
+                session = create_session(credentials, pool_size(config))
+            self._sessions[config_file] = (stamp, credentials, session)
+            return session
+
+
+def file_stamp(path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+
+def pool_size(config):
+    if config.has_section('api'):
+        return config['api'].getint('pool_size', DEFAULT_POOL_SIZE)
+    return DEFAULT_POOL_SIZE
+
+
+def base_url(config):
+    """
+    The Bricklink API root, which [api] base_url can point at a stand-in
+    server. bricklink_py reads it from a module global, so it applies to
+    every session in the process.
+    """
+    url = DEFAULT_BASE_URL
+    if config.has_section('api'):
+        url = config['api'].get('base_url', DEFAULT_BASE_URL)
+    return url if url.endswith('/') else url + '/'
+
+
+def create_session(credentials, pool_size=DEFAULT_POOL_SIZE):
+    consumer_key, consumer_secret, token_value, token_secret = credentials
+    session = Bricklink(
+        consumer_key=consumer_key,
+        consumer_secret=consumer_secret,
+        token=token_value,
+        token_secret=token_secret
+    )
+
+    # The default pool only keeps 10 connections, so concurrent fetches
+    # beyond that would keep opening and dropping connections
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.oauth_session.mount('https://', adapter)
+    session.oauth_session.mount('http://', adapter)
+    return session
+
+
+_resize_lock = threading.Lock()
+
+
+def ensure_pool_size(session, size):
+    """
+    Grow the keep-alive connection pool of session to at least size
+    connections. The adapter is resized in place, so a recording adapter
+    wrapped around it keeps working.
+    """
+    with _resize_lock:
+        for prefix in ('https://', 'http://'):
+            adapter = session.oauth_session.get_adapter(prefix)
+            # replay.RecordingAdapter sends through the adapter it wraps
+            adapter = getattr(adapter, 'adapter', adapter)
+            if isinstance(adapter, HTTPAdapter) and adapter._pool_maxsize < size:
+                logging.debug('Growing the Bricklink connection pool to ' + str(size))
+                adapter.init_poolmanager(adapter._pool_connections, size, block=adapter._pool_block)
+
+
+provider = SessionProvider()
+
+
+def get_session(config_file='config.ini'):
+    return provider.get_session(config_file)
@@ -0,0 +1,38 @@
+"""
+Named cell styles shared by the sheet writers.
+
+Registering the styles once per workbook and referring to them by name
+avoids creating new style objects for every cell, and is the only way to
+style cells in openpyxl's write-only mode.
+"""
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, NamedStyle, PatternFill
+
+HEADER_COLOR = "00C0C0C0"
+
+CENTER_STYLE = 'bricklink_center'
+HEADER_STYLE = 'bricklink_header'
+
+
+def register_styles(workbook):
+    """Add the named styles to workbook unless it already has them."""
+    if CENTER_STYLE not in workbook.named_styles:
+        center = NamedStyle(name=CENTER_STYLE)
+        center.alignment = Alignment(horizontal="center", vertical="center")
+        workbook.add_named_style(center)
+
+    if HEADER_STYLE not in workbook.named_styles:
+        header = NamedStyle(name=HEADER_STYLE)
+        header.alignment = Alignment(horizontal="center", vertical="center")
+        header.fill = PatternFill(start_color=HEADER_COLOR, end_color=HEADER_COLOR, fill_type="solid")
+        workbook.add_named_style(header)
+
+
+def styled_row(worksheet, values, style):
+    """Build a row of write-only cells that all use the named style."""
+    row = []
+    for value in values:
+        cell = WriteOnlyCell(worksheet, value=value)
+        cell.style = style
+        row.append(cell)
+    return row
@@ -0,0 +1,62 @@
+"""
+Snapshot of the whole store inventory.
+
+Updating a row of the Inventory sheet needs the quantity Bricklink has for
+its listing, which costs one get_store_inventory call per row. The store
+inventory can also be listed in a single get_store_inventories call, so
+with --bulk-snapshot inventory_update downloads it once and reads every
+row's listing from this snapshot instead.
+
+The snapshot is indexed by inventory id and by (item no, color id,
+condition), which also makes it cheap to find listings that are on
+Bricklink but not in the sheet, and new rows that look like a listing the
+store already has.
+"""
+import logging
+
+from rate_limit import limiter
+
+
+def listing_key(number, color_id, condition):
+    return (str(number), int(color_id), condition)
+
+
+class StoreSnapshot:
+
+    def __init__(self, listings):
+        self.by_id = {}
+        self.by_key = {}
+        for listing in listings:
+            self.by_id[int(listing['inventory_id'])] = listing
+            key = listing_key(listing['item']['no'], listing['color_id'], listing['new_or_used'])
+            self.by_key.setdefault(key, []).append(listing)
+
+    @classmethod
+    def fetch(cls, session):
+        """Download the store inventory in one call."""
+        listings = limiter.call(session.store_inventory.get_store_inventories) or []
+        logging.info('Store inventory has ' + str(len(listings)) + ' listings')
+        return cls(listings)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def get(self, inventory_id):
+        """The listing with this inventory id, or None."""
+        return self.by_id.get(int(inventory_id))
+
+    def find(self, number, color_id, condition):
+        """Every listing of a part in a color and condition."""
+        return self.by_key.get(listing_key(number, color_id, condition), [])
+
+    def missing(self, inventory_ids):
+        """Listings whose inventory id is not one of inventory_ids, in id order."""
+        known = set(int(inventory_id) for inventory_id in inventory_ids)
+        return [self.by_id[inventory_id] for inventory_id in sorted(self.by_id) if inventory_id not in known]
+
+
+def log_listing(listing):
+    item = listing['item']
+    logging.warning('  Inventory Id ' + str(listing['inventory_id']) + ': ' + str(item.get('type')) + ' ' +
+                    str(item['no']) + ', color ' + str(listing['color_id']) + ', condition ' +
+                    str(listing['new_or_used']) + ', quantity ' + str(listing.get('quantity')))